@@ -1,22 +1,44 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
-from fastapi.responses import FileResponse, Response
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, Query, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import and_, func, or_
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime
 import os
 import sys
 import uuid
+import base64
 import csv
 import io
+import asyncio
+import hashlib
+import json
 import logging
-import threading
+import shutil
+import tempfile
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from models import Call, Evaluation, SessionLocal, init_db
-from services.transcription_service import transcribe_audio
-from services.evaluation_service import evaluate_transcription
-from services.websocket_service import manager
+from models import Call, CallPhaseTiming, Evaluation, ScoreRollup, SessionLocal, init_db
+from config import (
+    UPLOAD_CHUNK_SIZE, UPLOAD_MAX_FILE_SIZE, CALLS_PAGE_SIZE_DEFAULT, CALLS_PAGE_SIZE_MAX, EXPORT_BATCH_SIZE,
+    SEARCH_PAGE_SIZE_DEFAULT, SEARCH_PAGE_SIZE_MAX, SSE_KEEPALIVE_INTERVAL
+)
+from services.transcription_service import transcribe_audio, transcription_cache_key, poll_stats
+from services.gemini_retry import retry_stats
+from services.gemini_scheduler import gemini_scheduler
+from services.evaluation_service import evaluate_transcription, evaluate_transcription_async
+from services.progress_service import progress_tracker
+from services.websocket_service import manager as progress_manager
+from services.phase_service import PhaseRecorder, phase_stats
+from services.job_queue import job_queue, QueueFullError
+from services.cache_service import transcription_cache, evaluation_cache, hash_file
+from services.audio_service import preprocess_audio, probe_duration, ffmpeg_available
+from services.export_service import COLUMNAR_FORMATS, columnar_available, write_columnar_export
+from services.rollup_service import record_evaluation, rebuild_rollups, rollup_summary
+from services.search_service import index_call, rebuild_search_index, search_calls
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -28,6 +50,40 @@ def get_db():
     finally:
         db.close()
 
+def write_upload_chunk(f, hasher, chunk: bytes):
+    hasher.update(chunk)
+    f.write(chunk)
+
+async def save_upload_stream(file: UploadFile, file_path: str):
+    # На event loop остается только чтение из запроса; запись на диск и хеширование - в пуле потоков,
+    # чтобы большая загрузка не задерживала остальные запросы и WebSocket
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        f = await run_in_threadpool(open, file_path, "wb")
+        try:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > UPLOAD_MAX_FILE_SIZE:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Файл {file.filename} превышает максимальный размер {UPLOAD_MAX_FILE_SIZE // (1024 * 1024)} МБ"
+                    )
+                await run_in_threadpool(write_upload_chunk, f, hasher, chunk)
+        finally:
+            await run_in_threadpool(f.close)
+    except BaseException:
+        if os.path.exists(file_path):
+            await run_in_threadpool(os.remove, file_path)
+        raise
+    finally:
+        await file.close()
+    
+    return size, hasher.hexdigest()
+
 @router.post("/upload")
 async def upload_files(
     files: List[UploadFile] = File(...),
@@ -39,6 +95,9 @@ async def upload_files(
     if not files:
         raise HTTPException(status_code=400, detail="Не указаны файлы для загрузки")
     
+    if not job_queue.has_capacity(db, len(files)):
+        raise HTTPException(status_code=503, detail="Очередь анализа переполнена, повторите загрузку позже")
+    
     uploaded_calls = []
     
     for file in files:
@@ -53,9 +112,8 @@ async def upload_files(
             os.makedirs(uploads_dir, exist_ok=True)
             file_path = os.path.join(uploads_dir, filename)
             
-            with open(file_path, "wb") as f:
-                content = await file.read()
-                f.write(content)
+            file_size, audio_hash = await save_upload_stream(file, file_path)
+            logger.info(f"Файл {file.filename} сохранен: {file_size} байт, sha256 {audio_hash}")
             
             call_date_obj = None
             if call_date:
@@ -67,6 +125,7 @@ async def upload_files(
             call = Call(
                 filename=file.filename,
                 audio_url=file_path,
+                audio_hash=audio_hash,
                 manager=manager,
                 call_date=call_date_obj,
                 call_identifier=call_identifier
@@ -84,9 +143,11 @@ async def upload_files(
                 "call_identifier": call.call_identifier
             })
             
-            thread = threading.Thread(target=analyze_in_background, args=(call.id, file_path), daemon=True)
-            thread.start()
-            logger.info(f"Автоматически запущен анализ для звонка {call.id}")
+            job_queue.enqueue(db, call.id, file_path)
+            logger.info(f"Автоматически поставлен в очередь анализ для звонка {call.id}")
+        except HTTPException:
+            db.rollback()
+            raise
         except Exception as e:
             db.rollback()
             raise HTTPException(status_code=500, detail=f"Ошибка при загрузке файла {file.filename}: {str(e)}")
@@ -96,86 +157,151 @@ async def upload_files(
     
     return {"calls": uploaded_calls}
 
-def update_progress(call_id: int, progress: int, status: str = None, message: str = None):
-    db_local = SessionLocal()
+def update_progress(call_id: int, progress: int, status: str = None, message: str = None, persisted: bool = False,
+                    phase: str = None, eta_seconds: float = None):
+    progress_tracker.update(call_id, progress, status, message, persisted, phase, eta_seconds)
+
+def save_evaluation(db: Session, call: Call, evaluation_result: dict, is_retest: bool) -> Evaluation:
+    evaluation = Evaluation(
+        call_id=call.id,
+        scores=evaluation_result["scores"],
+        итоговая_оценка=evaluation_result["итоговая_оценка"],
+        нарушения=evaluation_result["нарушения"],
+        комментарии=evaluation_result["комментарии"],
+        is_retest=is_retest
+    )
+    previous = call.latest_evaluation
+    db.add(evaluation)
+    db.flush()
+    record_evaluation(db, call, evaluation, previous)
+    index_call(db, call, evaluation)
+    # Сводка последней оценки хранится прямо в calls, чтобы список и экспорт обходились без подзапросов
+    call.set_latest_evaluation(evaluation)
+    return evaluation
+
+def store_retest(db: Session, call: Call, evaluation_result: dict) -> Evaluation:
+    evaluation = save_evaluation(db, call, evaluation_result, is_retest=True)
+    db.commit()
+    db.refresh(evaluation)
+    return evaluation
+
+def run_retest(db: Session, call: Call, bypass_cache: bool, on_progress=None) -> Evaluation:
+    evaluation_result = evaluate_transcription(call.transcription, use_cache=not bypass_cache, on_progress=on_progress)
+    return store_retest(db, call, evaluation_result)
+
+def retest_in_background(call_id: int, bypass_cache: bool = False):
+    db = SessionLocal()
+    phases = PhaseRecorder(call_id)
     try:
-        call_local = db_local.query(Call).filter(Call.id == call_id).first()
-        if call_local:
-            call_local.progress = progress
-            if status:
-                call_local.status = status
-            db_local.commit()
+        update_progress(call_id, 10, "processing", "Начало повторной оценки...")
+        
+        call = db.query(Call).filter(Call.id == call_id).first()
+        if not call:
+            raise Exception(f"Звонок {call_id} не найден")
+        if not call.transcription:
+            raise Exception(f"У звонка {call_id} нет транскрипции")
+        
+        evaluation = run_retest(db, call, bypass_cache, phases)
+        phases.save(db)
+        # Звонок, у которого упала первая оценка, после успешной повторной считается проанализированным
+        call.status = "completed"
+        call.progress = 100
+        db.commit()
+        logger.info(f"Повторная оценка звонка {call_id} завершена, итоговый балл: {evaluation.итоговая_оценка}")
+        
+        update_progress(call_id, 100, "completed", "Повторная оценка завершена", persisted=True)
     except Exception as e:
-        logger.error(f"Ошибка обновления прогресса: {e}")
+        logger.error(f"Ошибка повторной оценки звонка {call_id}: {e}")
+        db.rollback()
+        update_progress(call_id, 100, "failed", f"Ошибка повторной оценки: {str(e)}")
+        raise
     finally:
-        db_local.close()
-    
-    manager.send_progress_sync(call_id, progress, status or "processing", message)
+        db.close()
 
 def analyze_in_background(call_id: int, audio_path: str):
+    # Одна сессия на всю задачу; между шагами она не держит соединение, оно возвращается в пул после commit
+    db = SessionLocal()
+    phases = PhaseRecorder(call_id)
     try:
         update_progress(call_id, 10, "processing", "Начало транскрипции...")
-        logger.info(f"Начало транскрипции файла {audio_path}")
         
-        transcription = transcribe_audio(audio_path)
+        call = db.query(Call).filter(Call.id == call_id).first()
+        if not call:
+            raise Exception(f"Звонок {call_id} не найден")
+        
+        audio_hash = call.audio_hash
+        if not audio_hash and os.path.exists(audio_path):
+            audio_hash = hash_file(audio_path)
+            call.audio_hash = audio_hash
+            db.commit()
+        
+        cache_key = transcription_cache_key(audio_hash) if audio_hash else None
+        transcription = transcription_cache.get(cache_key) if cache_key else None
+        audio_stats = None
+        if transcription:
+            logger.info(f"Транскрипция звонка {call_id} найдена в кеше, Gemini не вызывается")
+            if ffmpeg_available():
+                audio_stats = {"duration": probe_duration(audio_path)}
+        else:
+            work_dir = tempfile.mkdtemp(prefix=f"call_{call_id}_")
+            try:
+                with phases.phase("preprocess"):
+                    prepared_path, audio_stats = preprocess_audio(audio_path, work_dir)
+                phases.audio_duration = (audio_stats or {}).get("duration")
+                logger.info(f"Начало транскрипции файла {prepared_path}")
+                transcription = transcribe_audio(prepared_path, on_progress=phases)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            if cache_key and transcription and transcription.strip():
+                transcription_cache.put(cache_key, transcription)
         
         if not transcription or len(transcription.strip()) == 0:
             raise Exception("Транскрипция пустая. Невозможно провести оценку.")
         
-        update_progress(call_id, 90, "processing", "Транскрипция завершена, сохранение...")
         logger.info(f"Транскрипция завершена, длина текста: {len(transcription)} символов")
         
-        db_local = SessionLocal()
-        try:
-            call_local = db_local.query(Call).filter(Call.id == call_id).first()
-            if call_local:
-                call_local.transcription = transcription
-                db_local.commit()
-                logger.info("Транскрипция сохранена в БД")
-        finally:
-            db_local.close()
+        with phases.phase("save"):
+            call.transcription = transcription
+            if audio_stats:
+                if audio_stats.get("duration"):
+                    call.duration = round(audio_stats["duration"], 2)
+                call.audio_stats = {**(call.audio_stats or {}), **audio_stats}
+            index_call(db, call)
+            db.commit()
+        logger.info("Транскрипция сохранена в БД")
         
-        update_progress(call_id, 95, "processing", "Начало оценки транскрипции...")
         logger.info("Начало оценки транскрипции")
         
-        evaluation_result = evaluate_transcription(transcription)
+        evaluation_result = evaluate_transcription(transcription, on_progress=phases)
         logger.info(f"Оценка завершена, итоговый балл: {evaluation_result.get('итоговая_оценка', 'N/A')}")
         
-        db_local = SessionLocal()
-        try:
-            call_local = db_local.query(Call).filter(Call.id == call_id).first()
-            if call_local:
-                evaluation = Evaluation(
-                    call_id=call_id,
-                    scores=evaluation_result["scores"],
-                    итоговая_оценка=evaluation_result["итоговая_оценка"],
-                    нарушения=evaluation_result["нарушения"],
-                    комментарии=evaluation_result["комментарии"],
-                    is_retest=False
-                )
-                db_local.add(evaluation)
-                call_local.status = "completed"
-                call_local.progress = 100
-                db_local.commit()
-                logger.info(f"Анализ звонка {call_id} успешно завершен")
-        finally:
-            db_local.close()
+        with phases.phase("evaluation_save"):
+            save_evaluation(db, call, evaluation_result, is_retest=False)
+            call.status = "completed"
+            call.progress = 100
+            db.flush()
+        phases.save(db)
+        db.commit()
+        logger.info(f"Анализ звонка {call_id} успешно завершен")
         
-        update_progress(call_id, 100, "completed", "Анализ завершен")
+        update_progress(call_id, 100, "completed", "Анализ завершен", persisted=True)
             
     except Exception as e:
         import traceback
         logger.error(f"Ошибка в фоновой задаче: {e}")
         logger.error(traceback.format_exc())
-        db_local = SessionLocal()
-        try:
-            call_local = db_local.query(Call).filter(Call.id == call_id).first()
-            if call_local:
-                call_local.status = "failed"
-                db_local.commit()
-        finally:
-            db_local.close()
+        db.rollback()
         update_progress(call_id, 0, "failed", f"Ошибка: {str(e)}")
+        try:
+            # Тайминги упавшего анализа тоже нужны: по ним видно, на какой фазе и через сколько произошел сбой
+            phases.save(db)
+            db.commit()
+        except Exception as save_error:
+            db.rollback()
+            logger.warning(f"Не удалось сохранить тайминги фаз звонка {call_id}: {save_error}")
+        raise
+    finally:
+        db.close()
 
 @router.post("/analyze/{call_id}")
 async def analyze_call(call_id: int, db: Session = Depends(get_db)):
@@ -205,18 +331,27 @@ async def analyze_call(call_id: int, db: Session = Depends(get_db)):
             logger.error(f"Путь не является файлом: {audio_path}")
             raise HTTPException(status_code=400, detail=f"Audio path is not a file: {audio_path}")
         
-        call.status = "processing"
-        call.progress = 0
-        db.commit()
+        existing = job_queue.active_job(db, call_id)
+        if existing:
+            return {
+                "call_id": call_id,
+                "job_id": existing.id,
+                "status": call.status or existing.status,
+                "progress": call.progress or 0,
+                "message": "Анализ звонка уже в очереди или выполняется, проверяйте статус через /api/analyze/{call_id}/status"
+            }
         
-        thread = threading.Thread(target=analyze_in_background, args=(call_id, audio_path), daemon=True)
-        thread.start()
+        try:
+            job = job_queue.enqueue(db, call_id, audio_path)
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e))
         
         return {
             "call_id": call_id,
-            "status": "processing",
+            "job_id": job.id,
+            "status": "queued",
             "progress": 0,
-            "message": "Анализ начат, проверяйте статус через /api/analyze/{call_id}/status"
+            "message": "Анализ поставлен в очередь, проверяйте статус через /api/analyze/{call_id}/status"
         }
     except HTTPException:
         raise
@@ -229,6 +364,16 @@ async def analyze_call(call_id: int, db: Session = Depends(get_db)):
 
 @router.get("/analyze/{call_id}/status")
 async def get_analyze_status(call_id: int, db: Session = Depends(get_db)):
+    state = progress_tracker.get(call_id)
+    if state:
+        return {
+            "call_id": call_id,
+            "status": state["status"],
+            "progress": state["progress"],
+            "phase": state["phase"],
+            "eta_seconds": round(state["eta_seconds"], 1) if state["eta_seconds"] is not None else None
+        }
+    
     call = db.query(Call).filter(Call.id == call_id).first()
     if not call:
         raise HTTPException(status_code=404, detail="Call not found")
@@ -239,8 +384,39 @@ async def get_analyze_status(call_id: int, db: Session = Depends(get_db)):
         "progress": call.progress or 0
     }
 
+@router.get("/progress/stream")
+async def stream_progress(
+    request: Request,
+    call_ids: Optional[List[int]] = Query(None),
+    manager: Optional[List[str]] = Query(None)
+):
+    # SSE для клиентов, у которых не работает WebSocket; подписка та же, что у /ws/progress
+    if not call_ids and not manager:
+        raise HTTPException(status_code=400, detail="Укажите call_ids или manager")
+    
+    subscriber = progress_manager.register()
+    await progress_manager.subscribe(subscriber, call_ids, manager)
+    
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    data = await asyncio.wait_for(subscriber.queue.get(), timeout=SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: progress\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            progress_manager.disconnect(subscriber)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/analyze/{call_id}/retest")
-async def retest_call(call_id: int, db: Session = Depends(get_db)):
+async def retest_call(call_id: int, bypass_cache: bool = False, db: Session = Depends(get_db)):
     call = db.query(Call).filter(Call.id == call_id).first()
     if not call:
         raise HTTPException(status_code=404, detail="Call not found")
@@ -248,20 +424,13 @@ async def retest_call(call_id: int, db: Session = Depends(get_db)):
     if not call.transcription:
         raise HTTPException(status_code=400, detail="Transcription not found")
     
-    evaluation_result = evaluate_transcription(call.transcription)
-    
-    evaluation = Evaluation(
-        call_id=call_id,
-        scores=evaluation_result["scores"],
-        итоговая_оценка=evaluation_result["итоговая_оценка"],
-        нарушения=evaluation_result["нарушения"],
-        комментарии=evaluation_result["комментарии"],
-        is_retest=True
+    # Запрос к Gemini занимает секунды и выполняется на event loop планировщика, этот loop его только ожидает
+    evaluation_result = await gemini_scheduler.run_async(
+        evaluate_transcription_async(call.transcription, use_cache=not bypass_cache)
     )
     
-    db.add(evaluation)
-    db.commit()
-    db.refresh(evaluation)
+    # Сводки и полнотекстовый индекс пересчитываются синхронно, поэтому запись - вне event loop
+    evaluation = await run_in_threadpool(store_retest, db, call, evaluation_result)
     
     return {
         "call_id": call_id,
@@ -275,15 +444,213 @@ async def retest_call(call_id: int, db: Session = Depends(get_db)):
         }
     }
 
-@router.get("/calls")
-async def get_calls(
+@router.post("/retest/batch")
+async def retest_batch(
+    call_ids: Optional[List[int]] = Query(None),
+    manager: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    bypass_cache: bool = False,
+    after_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    if not call_ids and not manager and not start_date and not end_date:
+        raise HTTPException(status_code=400, detail="Укажите call_ids или фильтр звонков (manager, start_date, end_date)")
+    
+    query = db.query(Call.id, Call.audio_url).filter(Call.transcription.isnot(None))
+    if call_ids:
+        query = query.filter(Call.id.in_(call_ids))
+    if after_id:
+        query = query.filter(Call.id > after_id)
+    query = apply_call_filters(query, manager, start_date, end_date)
+    
+    # Звонки, которые уже анализируются или переоцениваются, повторно не ставим
+    active_ids = job_queue.active_call_ids_query(db).subquery()
+    skipped_ids = [row.id for row in query.filter(Call.id.in_(active_ids)).order_by(Call.id)]
+    query = query.filter(Call.id.notin_(active_ids))
+    
+    total = query.count()
+    if not total and not skipped_ids:
+        raise HTTPException(status_code=400, detail="Не найдено звонков с транскрипцией для повторной оценки")
+    
+    jobs = []
+    if total:
+        # Пачка больше свободного места в очереди ставится частями: остаток - повторным запросом с after_id
+        calls = query.order_by(Call.id).limit(job_queue.free_capacity(db)).all()
+        try:
+            jobs = job_queue.enqueue_retests(db, [(row.id, row.audio_url) for row in calls], bypass_cache)
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        # Задача могла появиться между выборкой и постановкой в очередь
+        enqueued_ids = {job.call_id for job in jobs}
+        raced_ids = [row.id for row in calls if row.id not in enqueued_ids]
+        skipped_ids = sorted(skipped_ids + raced_ids)
+        total -= len(raced_ids)
+    
+    remaining = total - len(jobs)
+    return {
+        "count": len(jobs),
+        "remaining": remaining,
+        "next_after_id": jobs[-1].call_id if remaining and jobs else None,
+        "skipped_call_ids": skipped_ids,
+        "bypass_cache": bypass_cache,
+        "jobs": [{"call_id": job.call_id, "job_id": job.id} for job in jobs],
+        "message": "Повторная оценка поставлена в очередь, прогресс по каждому звонку - через /ws/analyze/{call_id}"
+    }
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    return {
+        "transcription": transcription_cache.stats(),
+        "evaluation": evaluation_cache.stats()
+    }
+
+@router.get("/gemini/stats")
+async def get_gemini_stats():
+    return {
+        "requests": retry_stats.snapshot(),
+        "file_polling": poll_stats.snapshot(),
+        "scheduler": gemini_scheduler.stats()
+    }
+
+def rollups_query(db: Session, period: str, manager: Optional[str], start_date: Optional[str], end_date: Optional[str]):
+    query = db.query(ScoreRollup).filter(ScoreRollup.period_type == period)
+    
+    if manager:
+        query = query.filter(ScoreRollup.manager == manager)
+    
+    if start_date:
+        query = query.filter(ScoreRollup.period_start >= datetime.fromisoformat(start_date.replace("Z", "+00:00")).date())
+    if end_date:
+        query = query.filter(ScoreRollup.period_start <= datetime.fromisoformat(end_date.replace("Z", "+00:00")).date())
+    
+    return query.order_by(ScoreRollup.period_start.desc(), ScoreRollup.manager)
+
+@router.get("/analytics")
+async def get_analytics(
+    period: str = Query("month", pattern="^(week|month)$"),
+    manager: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    try:
+        query = rollups_query(db, period, manager, start_date, end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный формат даты")
+    
+    rollups = query.all()
+    return {"period": period, "items": [rollup_summary(rollup) for rollup in rollups]}
+
+@router.post("/analytics/rebuild")
+async def rebuild_analytics():
+    rows = await run_in_threadpool(rebuild_rollups)
+    return {"status": "ok", "rows": rows}
+
+@router.get("/search")
+async def search(
+    q: str = Query(..., min_length=2),
     manager: Optional[str] = None,
+    limit: int = Query(SEARCH_PAGE_SIZE_DEFAULT, ge=1, le=SEARCH_PAGE_SIZE_MAX),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db)
+):
+    total, hits = search_calls(db, q, manager, limit, offset)
+    calls = {call.id: call for call in db.query(Call).filter(Call.id.in_([hit[0] for hit in hits])).all()}
+    
+    results = []
+    for call_id, rank, transcription_highlight, comments_highlight in hits:
+        call = calls.get(call_id)
+        if not call:
+            continue
+        results.append({
+            "id": call.id,
+            "filename": call.filename,
+            "manager": call.manager,
+            "call_date": call.call_date.isoformat() if call.call_date else None,
+            "call_identifier": call.call_identifier,
+            "created_at": call.created_at.isoformat(),
+            "evaluation": {
+                "итоговая_оценка": call.итоговая_оценка,
+                "нарушения": call.нарушения
+            } if call.latest_evaluation_id else None,
+            "rank": round(rank, 4),
+            "transcription_highlight": transcription_highlight,
+            "comments_highlight": comments_highlight
+        })
+    
+    next_offset = offset + limit if offset + limit < total else None
+    return {"query": q, "total": total, "results": results, "next_offset": next_offset}
+
+@router.post("/search/rebuild")
+async def rebuild_search():
+    indexed = await run_in_threadpool(rebuild_search_index)
+    return {"status": "ok", "indexed": indexed}
+
+@router.get("/calls/{call_id}/timings")
+async def get_call_timings(call_id: int, db: Session = Depends(get_db)):
+    if not db.query(Call.id).filter(Call.id == call_id).first():
+        raise HTTPException(status_code=404, detail="Call not found")
+    
+    timings = db.query(CallPhaseTiming).filter(
+        CallPhaseTiming.call_id == call_id
+    ).order_by(CallPhaseTiming.started_at, CallPhaseTiming.id).all()
+    
+    return {
+        "call_id": call_id,
+        "timings": [
+            {
+                "phase": timing.phase,
+                "started_at": timing.started_at.isoformat() if timing.started_at else None,
+                "finished_at": timing.finished_at.isoformat() if timing.finished_at else None,
+                "duration": round(timing.duration, 3) if timing.duration is not None else None,
+                "details": timing.details
+            }
+            for timing in timings
+        ]
+    }
+
+@router.get("/timings")
+async def get_timings(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
-    query = db.query(Call)
+    query = db.query(
+        CallPhaseTiming.phase,
+        func.count(CallPhaseTiming.id),
+        func.avg(CallPhaseTiming.duration),
+        func.max(CallPhaseTiming.duration)
+    )
     
+    try:
+        if start_date:
+            query = query.filter(CallPhaseTiming.started_at >= datetime.fromisoformat(start_date.replace("Z", "+00:00")))
+        if end_date:
+            query = query.filter(CallPhaseTiming.started_at <= datetime.fromisoformat(end_date.replace("Z", "+00:00")))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный формат даты")
+    
+    rows = query.group_by(CallPhaseTiming.phase).all()
+    return {
+        "phases": {
+            phase: {"count": count, "avg": round(avg or 0, 3), "max": round(max_duration or 0, 3)}
+            for phase, count, avg, max_duration in rows
+        },
+        "expected": phase_stats.snapshot()
+    }
+
+def encode_cursor(created_at: datetime, call_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{call_id}".encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, call_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(created_at), int(call_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный cursor")
+
+def apply_call_filters(query, manager: Optional[str], start_date: Optional[str], end_date: Optional[str]):
     if manager:
         query = query.filter(Call.manager == manager)
     
@@ -301,14 +668,37 @@ async def get_calls(
         except:
             pass
     
-    calls = query.order_by(Call.created_at.desc()).all()
+    return query
+
+def calls_page_query(db: Session, manager: Optional[str], start_date: Optional[str], end_date: Optional[str],
+                     cursor: Optional[str], limit: int):
+    query = apply_call_filters(db.query(Call), manager, start_date, end_date)
+    
+    if cursor:
+        cursor_created_at, cursor_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            Call.created_at < cursor_created_at,
+            and_(Call.created_at == cursor_created_at, Call.id < cursor_id)
+        ))
+    
+    # Лишняя строка показывает, есть ли следующая страница
+    return query.order_by(Call.created_at.desc(), Call.id.desc()).limit(limit + 1)
+
+@router.get("/calls")
+async def get_calls(
+    manager: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(CALLS_PAGE_SIZE_DEFAULT, ge=1, le=CALLS_PAGE_SIZE_MAX),
+    db: Session = Depends(get_db)
+):
+    calls = calls_page_query(db, manager, start_date, end_date, cursor, limit).all()
+    has_more = len(calls) > limit
+    calls = calls[:limit]
     
     result = []
     for call in calls:
-        latest_evaluation = db.query(Evaluation).filter(
-            Evaluation.call_id == call.id
-        ).order_by(Evaluation.created_at.desc()).first()
-        
         result.append({
             "id": call.id,
             "filename": call.filename,
@@ -317,12 +707,19 @@ async def get_calls(
             "call_identifier": call.call_identifier,
             "created_at": call.created_at.isoformat(),
             "evaluation": {
-                "итоговая_оценка": latest_evaluation.итоговая_оценка if latest_evaluation else None,
-                "нарушения": latest_evaluation.нарушения if latest_evaluation else False
-            } if latest_evaluation else None
+                "итоговая_оценка": call.итоговая_оценка,
+                "нарушения": call.нарушения
+            } if call.latest_evaluation_id else None
         })
     
-    return {"calls": result}
+    next_cursor = encode_cursor(calls[-1].created_at, calls[-1].id) if has_more and calls else None
+    
+    return {"calls": result, "next_cursor": next_cursor}
+
+def call_evaluations_query(db: Session, call_id: int):
+    return db.query(Evaluation).filter(
+        Evaluation.call_id == call_id
+    ).order_by(Evaluation.created_at.desc())
 
 @router.get("/calls/{call_id}")
 async def get_call(call_id: int, db: Session = Depends(get_db)):
@@ -330,9 +727,7 @@ async def get_call(call_id: int, db: Session = Depends(get_db)):
     if not call:
         raise HTTPException(status_code=404, detail="Call not found")
     
-    evaluations = db.query(Evaluation).filter(
-        Evaluation.call_id == call_id
-    ).order_by(Evaluation.created_at.desc()).all()
+    evaluations = call_evaluations_query(db, call_id).all()
     
     return {
         "id": call.id,
@@ -342,6 +737,7 @@ async def get_call(call_id: int, db: Session = Depends(get_db)):
         "call_identifier": call.call_identifier,
         "transcription": call.transcription,
         "duration": call.duration,
+        "audio_stats": call.audio_stats,
         "created_at": call.created_at.isoformat(),
         "evaluations": [
             {
@@ -357,44 +753,13 @@ async def get_call(call_id: int, db: Session = Depends(get_db)):
         ]
     }
 
-@router.get("/export")
-async def export_calls(
-    manager: Optional[str] = None,
-    start_date: Optional[str] = None,
-    end_date: Optional[str] = None,
-    db: Session = Depends(get_db)
-):
-    query = db.query(Call)
-    
-    if manager:
-        query = query.filter(Call.manager == manager)
-    
-    if start_date:
-        try:
-            start_dt = datetime.fromisoformat(start_date.replace("Z", "+00:00"))
-            query = query.filter(Call.call_date >= start_dt)
-        except:
-            pass
-    
-    if end_date:
-        try:
-            end_dt = datetime.fromisoformat(end_date.replace("Z", "+00:00"))
-            query = query.filter(Call.call_date <= end_dt)
-        except:
-            pass
-    
-    calls = query.order_by(Call.created_at.desc()).all()
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    writer.writerow([
+EXPORT_HEADER_ROWS = [
+    [
         "Номер", "Дата звонка", "Дата оценки", "Месяц оценки", "Длительность звонка", "Менеджер",
         "Установление контакта", "", "Диагностика", "", "Продажа", "", "Презентация", "",
         "Работа с возражениями", "", "Завершение", "", "", "", "Итоговая оценка"
-    ])
-    
-    writer.writerow([
+    ],
+    [
         "", "", "", "", "", "",
         "1.1 Приветствие", "1.2 Наличие техники",
         "2.1 Выявление цели, боли", "2.2 Критерии обучения",
@@ -403,65 +768,112 @@ async def export_calls(
         "5.1 Выявление возражений", "5.2 Отработка возражений",
         "6. Контрольные точки", "7. Корректность сделки", "8. Грамотность", "9. Нарушения",
         ""
-    ])
+    ]
+]
+
+EXPORT_SCORE_KEYS = ["1.1", "1.2", "2.1", "2.2", "3.1", "3.2", "4.1", "4.2", "5.1", "5.2", "6", "7", "8"]
+
+MONTH_NAMES = {
+    1: "январь", 2: "февраль", 3: "март", 4: "апрель",
+    5: "май", 6: "июнь", 7: "июль", 8: "август",
+    9: "сентябрь", 10: "октябрь", 11: "ноябрь", 12: "декабрь"
+}
+
+def export_row(idx: int, call: Call, evaluation: Evaluation) -> list:
+    scores = evaluation.scores or {}
+    evaluation_date = evaluation.created_at
     
-    for idx, call in enumerate(calls, 1):
-        latest_evaluation = db.query(Evaluation).filter(
-            Evaluation.call_id == call.id
-        ).order_by(Evaluation.created_at.desc()).first()
-        
-        if not latest_evaluation:
-            continue
-        
-        scores = latest_evaluation.scores or {}
-        evaluation_date = latest_evaluation.created_at
-        
-        month_names = {
-            1: "январь", 2: "февраль", 3: "март", 4: "апрель",
-            5: "май", 6: "июнь", 7: "июль", 8: "август",
-            9: "сентябрь", 10: "октябрь", 11: "ноябрь", 12: "декабрь"
-        }
-        month = ""
-        if evaluation_date:
-            month = month_names.get(evaluation_date.month, "")
-        
-        violation_text = "FALSE"
-        if latest_evaluation.нарушения:
-            violation_text = "TRUE"
-        elif scores.get("9", {}).get("violation", False):
-            violation_text = "TRUE"
-        
-        row = [
-            idx,
-            call.call_date.strftime("%Y-%m-%d") if call.call_date else "",
-            evaluation_date.strftime("%Y-%m-%d %H:%M:%S") if evaluation_date else "",
-            month,
-            call.duration or "",
-            call.manager or "",
-            scores.get("1.1", {}).get("score", ""),
-            scores.get("1.2", {}).get("score", ""),
-            scores.get("2.1", {}).get("score", ""),
-            scores.get("2.2", {}).get("score", ""),
-            scores.get("3.1", {}).get("score", ""),
-            scores.get("3.2", {}).get("score", ""),
-            scores.get("4.1", {}).get("score", ""),
-            scores.get("4.2", {}).get("score", ""),
-            scores.get("5.1", {}).get("score", ""),
-            scores.get("5.2", {}).get("score", ""),
-            scores.get("6", {}).get("score", ""),
-            scores.get("7", {}).get("score", ""),
-            scores.get("8", {}).get("score", ""),
-            violation_text,
-            latest_evaluation.итоговая_оценка or ""
-        ]
-        
-        writer.writerow(row)
+    month = ""
+    if evaluation_date:
+        month = MONTH_NAMES.get(evaluation_date.month, "")
     
-    output.seek(0)
-    csv_content = output.getvalue().encode("utf-8-sig")
+    violation_text = "FALSE"
+    if evaluation.нарушения:
+        violation_text = "TRUE"
+    elif scores.get("9", {}).get("violation", False):
+        violation_text = "TRUE"
     
-    return Response(
-        content=csv_content,
+    return [
+        idx,
+        call.call_date.strftime("%Y-%m-%d") if call.call_date else "",
+        evaluation_date.strftime("%Y-%m-%d %H:%M:%S") if evaluation_date else "",
+        month,
+        call.duration or "",
+        call.manager or "",
+        *[scores.get(key, {}).get("score", "") for key in EXPORT_SCORE_KEYS],
+        violation_text,
+        evaluation.итоговая_оценка or ""
+    ]
+
+def export_query(db: Session, manager: Optional[str], start_date: Optional[str], end_date: Optional[str]):
+    return apply_call_filters(
+        db.query(Call, Evaluation).join(Evaluation, Evaluation.id == Call.latest_evaluation_id),
+        manager, start_date, end_date
+    ).order_by(Call.created_at.desc(), Call.id.desc())
+
+def stream_export_csv(manager: Optional[str], start_date: Optional[str], end_date: Optional[str]):
+    # Своя сессия: генератор дочитывает данные уже после выхода из обработчика запроса
+    db = SessionLocal()
+    try:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(EXPORT_HEADER_ROWS)
+        yield "\ufeff".encode("utf-8") + buffer.getvalue().encode("utf-8")
+        
+        query = export_query(db, manager, start_date, end_date).yield_per(EXPORT_BATCH_SIZE)
+        
+        buffer.seek(0)
+        buffer.truncate()
+        rows_in_buffer = 0
+        for idx, (call, evaluation) in enumerate(query, 1):
+            writer.writerow(export_row(idx, call, evaluation))
+            rows_in_buffer += 1
+            if rows_in_buffer >= EXPORT_BATCH_SIZE:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                rows_in_buffer = 0
+        if rows_in_buffer:
+            yield buffer.getvalue().encode("utf-8")
+    finally:
+        db.close()
+
+def export_columnar_file(output_format: str, manager: Optional[str], start_date: Optional[str], end_date: Optional[str]) -> str:
+    _, extension = COLUMNAR_FORMATS[output_format]
+    fd, path = tempfile.mkstemp(suffix=extension, prefix="calls_export_")
+    os.close(fd)
+    db = SessionLocal()
+    try:
+        query = export_query(db, manager, start_date, end_date).yield_per(EXPORT_BATCH_SIZE)
+        write_columnar_export(query, output_format, path)
+        return path
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        db.close()
+
+@router.get("/export")
+async def export_calls(
+    manager: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    format: str = Query("csv", pattern="^(csv|parquet|arrow)$")
+):
+    if format in COLUMNAR_FORMATS:
+        if not columnar_available():
+            raise HTTPException(status_code=501, detail="Экспорт в Parquet/Arrow недоступен: не установлен pyarrow")
+        media_type, extension = COLUMNAR_FORMATS[format]
+        path = await run_in_threadpool(export_columnar_file, format, manager, start_date, end_date)
+        return FileResponse(
+            path,
+            media_type=media_type,
+            filename=f"calls_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}{extension}",
+            background=BackgroundTask(os.remove, path)
+        )
+    
+    return StreamingResponse(
+        stream_export_csv(manager, start_date, end_date),
         media_type="text/csv; charset=utf-8-sig",
         headers={
             "Content-Disposition": f'attachment; filename="calls_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv"'
@@ -474,76 +886,15 @@ async def export_call(call_id: int, db: Session = Depends(get_db)):
     if not call:
         raise HTTPException(status_code=404, detail="Call not found")
     
-    latest_evaluation = db.query(Evaluation).filter(
-        Evaluation.call_id == call_id
-    ).order_by(Evaluation.created_at.desc()).first()
+    latest_evaluation = call.latest_evaluation
     
     if not latest_evaluation:
         raise HTTPException(status_code=400, detail="No evaluation found for this call")
     
     output = io.StringIO()
     writer = csv.writer(output)
-    
-    writer.writerow([
-        "Номер", "Дата звонка", "Дата оценки", "Месяц оценки", "Длительность звонка", "Менеджер",
-        "Установление контакта", "", "Диагностика", "", "Продажа", "", "Презентация", "",
-        "Работа с возражениями", "", "Завершение", "", "", "", "Итоговая оценка"
-    ])
-    
-    writer.writerow([
-        "", "", "", "", "", "",
-        "1.1 Приветствие", "1.2 Наличие техники",
-        "2.1 Выявление цели, боли", "2.2 Критерии обучения",
-        "3.1 Запись на пробное", "3.2 Повторная связь",
-        "4.1 Презентация формата", "4.2 Презентация до пробного",
-        "5.1 Выявление возражений", "5.2 Отработка возражений",
-        "6. Контрольные точки", "7. Корректность сделки", "8. Грамотность", "9. Нарушения",
-        ""
-    ])
-    
-    scores = latest_evaluation.scores or {}
-    evaluation_date = latest_evaluation.created_at
-    
-    month_names = {
-        1: "январь", 2: "февраль", 3: "март", 4: "апрель",
-        5: "май", 6: "июнь", 7: "июль", 8: "август",
-        9: "сентябрь", 10: "октябрь", 11: "ноябрь", 12: "декабрь"
-    }
-    month = ""
-    if evaluation_date:
-        month = month_names.get(evaluation_date.month, "")
-    
-    violation_text = "FALSE"
-    if latest_evaluation.нарушения:
-        violation_text = "TRUE"
-    elif scores.get("9", {}).get("violation", False):
-        violation_text = "TRUE"
-    
-    row = [
-        1,
-        call.call_date.strftime("%Y-%m-%d") if call.call_date else "",
-        evaluation_date.strftime("%Y-%m-%d %H:%M:%S") if evaluation_date else "",
-        month,
-        call.duration or "",
-        call.manager or "",
-        scores.get("1.1", {}).get("score", ""),
-        scores.get("1.2", {}).get("score", ""),
-        scores.get("2.1", {}).get("score", ""),
-        scores.get("2.2", {}).get("score", ""),
-        scores.get("3.1", {}).get("score", ""),
-        scores.get("3.2", {}).get("score", ""),
-        scores.get("4.1", {}).get("score", ""),
-        scores.get("4.2", {}).get("score", ""),
-        scores.get("5.1", {}).get("score", ""),
-        scores.get("5.2", {}).get("score", ""),
-        scores.get("6", {}).get("score", ""),
-        scores.get("7", {}).get("score", ""),
-        scores.get("8", {}).get("score", ""),
-        violation_text,
-        latest_evaluation.итоговая_оценка or ""
-    ]
-    
-    writer.writerow(row)
+    writer.writerows(EXPORT_HEADER_ROWS)
+    writer.writerow(export_row(1, call, latest_evaluation))
     
     output.seek(0)
     csv_content = output.getvalue().encode("utf-8-sig")
@@ -555,4 +906,3 @@ async def export_call(call_id: int, db: Session = Depends(get_db)):
             "Content-Disposition": f'attachment; filename="call_{call_id}_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv"'
         }
     )
-
@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,3 +9,77 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GEMINI_TRANSCRIPTION_MODEL = os.getenv("GEMINI_TRANSCRIPTION_MODEL", "gemini-2.5-flash")
 GEMINI_EVALUATION_MODEL = os.getenv("GEMINI_EVALUATION_MODEL", "gemini-2.0-flash")
 
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+UPLOAD_MAX_FILE_SIZE = int(os.getenv("UPLOAD_MAX_FILE_SIZE", str(500 * 1024 * 1024)))
+
+ANALYSIS_QUEUE_MAX_SIZE = int(os.getenv("ANALYSIS_QUEUE_MAX_SIZE", "1000"))
+ANALYSIS_QUEUE_POLL_INTERVAL = float(os.getenv("ANALYSIS_QUEUE_POLL_INTERVAL", "2.0"))
+ANALYSIS_LEASE_SECONDS = int(os.getenv("ANALYSIS_LEASE_SECONDS", "120"))
+ANALYSIS_HEARTBEAT_INTERVAL = float(os.getenv("ANALYSIS_HEARTBEAT_INTERVAL", "30"))
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "3"))
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}:{os.getpid()}")
+
+GEMINI_TRANSCRIPTION_RPM = int(os.getenv("GEMINI_TRANSCRIPTION_RPM", "60"))
+GEMINI_TRANSCRIPTION_TPM = int(os.getenv("GEMINI_TRANSCRIPTION_TPM", "1000000"))
+GEMINI_TRANSCRIPTION_MAX_CONCURRENCY = int(os.getenv("GEMINI_TRANSCRIPTION_MAX_CONCURRENCY", "4"))
+GEMINI_EVALUATION_RPM = int(os.getenv("GEMINI_EVALUATION_RPM", "60"))
+GEMINI_EVALUATION_TPM = int(os.getenv("GEMINI_EVALUATION_TPM", "1000000"))
+GEMINI_EVALUATION_MAX_CONCURRENCY = int(os.getenv("GEMINI_EVALUATION_MAX_CONCURRENCY", "4"))
+GEMINI_AUDIO_TOKENS_PER_SECOND = int(os.getenv("GEMINI_AUDIO_TOKENS_PER_SECOND", "32"))
+# Воркер очереди ждет ответа Gemini для своего звонка целиком, поэтому одновременно анализируется не больше
+# ANALYSIS_WORKERS звонков; по умолчанию воркеров столько, чтобы упираться в лимиты Gemini, а не в потоки
+ANALYSIS_WORKERS = int(os.getenv(
+    "ANALYSIS_WORKERS", str(max(GEMINI_TRANSCRIPTION_MAX_CONCURRENCY, GEMINI_EVALUATION_MAX_CONCURRENCY))
+))
+
+GEMINI_RETRY_MAX_ATTEMPTS = int(os.getenv("GEMINI_RETRY_MAX_ATTEMPTS", "4"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "2.0"))
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "60"))
+GEMINI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("GEMINI_BREAKER_FAILURE_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "60"))
+GEMINI_FILE_POLL_INITIAL_INTERVAL = float(os.getenv("GEMINI_FILE_POLL_INITIAL_INTERVAL", "0.5"))
+GEMINI_FILE_POLL_MAX_INTERVAL = float(os.getenv("GEMINI_FILE_POLL_MAX_INTERVAL", "5.0"))
+GEMINI_FILE_POLL_BACKOFF = float(os.getenv("GEMINI_FILE_POLL_BACKOFF", "1.5"))
+GEMINI_FILE_PROCESSING_TIMEOUT = float(os.getenv("GEMINI_FILE_PROCESSING_TIMEOUT", "120"))
+GEMINI_FILE_PROCESSING_TIMEOUT_PER_MB = float(os.getenv("GEMINI_FILE_PROCESSING_TIMEOUT_PER_MB", "30"))
+
+TRANSCRIPTION_CACHE_ENABLED = os.getenv("TRANSCRIPTION_CACHE_ENABLED", "true").lower() == "true"
+TRANSCRIPTION_CACHE_MAX_ENTRIES = int(os.getenv("TRANSCRIPTION_CACHE_MAX_ENTRIES", "10000"))
+TRANSCRIPTION_CACHE_MAX_BYTES = int(os.getenv("TRANSCRIPTION_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+EVALUATION_CACHE_ENABLED = os.getenv("EVALUATION_CACHE_ENABLED", "true").lower() == "true"
+EVALUATION_CACHE_MAX_ENTRIES = int(os.getenv("EVALUATION_CACHE_MAX_ENTRIES", "20000"))
+EVALUATION_CACHE_MAX_BYTES = int(os.getenv("EVALUATION_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+SILENCE_NOISE_DB = float(os.getenv("SILENCE_NOISE_DB", "-35"))
+SILENCE_MIN_DURATION = float(os.getenv("SILENCE_MIN_DURATION", "0.5"))
+TRANSCRIPTION_CHUNKING_ENABLED = os.getenv("TRANSCRIPTION_CHUNKING_ENABLED", "true").lower() == "true"
+TRANSCRIPTION_CHUNK_SECONDS = float(os.getenv("TRANSCRIPTION_CHUNK_SECONDS", "600"))
+TRANSCRIPTION_CHUNK_OVERLAP_SECONDS = float(os.getenv("TRANSCRIPTION_CHUNK_OVERLAP_SECONDS", "5"))
+TRANSCRIPTION_CHUNK_CONCURRENCY = int(os.getenv("TRANSCRIPTION_CHUNK_CONCURRENCY", "4"))
+TRANSCRIPTION_STITCH_WINDOW_WORDS = int(os.getenv("TRANSCRIPTION_STITCH_WINDOW_WORDS", "60"))
+AUDIO_PREPROCESSING_ENABLED = os.getenv("AUDIO_PREPROCESSING_ENABLED", "true").lower() == "true"
+AUDIO_SAMPLE_RATE = int(os.getenv("AUDIO_SAMPLE_RATE", "16000"))
+AUDIO_BITRATE = os.getenv("AUDIO_BITRATE", "24k")
+AUDIO_VAD_AGGRESSIVENESS = int(os.getenv("AUDIO_VAD_AGGRESSIVENESS", "2"))
+AUDIO_VAD_PADDING_SECONDS = float(os.getenv("AUDIO_VAD_PADDING_SECONDS", "0.3"))
+
+CALLS_PAGE_SIZE_DEFAULT = int(os.getenv("CALLS_PAGE_SIZE_DEFAULT", "50"))
+CALLS_PAGE_SIZE_MAX = int(os.getenv("CALLS_PAGE_SIZE_MAX", "200"))
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+EXPORT_COMPRESSION = os.getenv("EXPORT_COMPRESSION", "zstd")
+
+SEARCH_PAGE_SIZE_DEFAULT = int(os.getenv("SEARCH_PAGE_SIZE_DEFAULT", "20"))
+SEARCH_PAGE_SIZE_MAX = int(os.getenv("SEARCH_PAGE_SIZE_MAX", "100"))
+SEARCH_SNIPPET_WORDS = int(os.getenv("SEARCH_SNIPPET_WORDS", "30"))
+
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", "2.0"))
+
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "memory").lower()
+PUBSUB_LOCAL_ADDRESS = os.getenv("PUBSUB_LOCAL_ADDRESS", "127.0.0.1:8765")
+PUBSUB_LOCAL_CLIENT_QUEUE_SIZE = int(os.getenv("PUBSUB_LOCAL_CLIENT_QUEUE_SIZE", "10000"))
+
+WS_CLIENT_QUEUE_SIZE = int(os.getenv("WS_CLIENT_QUEUE_SIZE", "100"))
+PROGRESS_SNAPSHOT_MAX_ENTRIES = int(os.getenv("PROGRESS_SNAPSHOT_MAX_ENTRIES", "10000"))
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
@@ -4,15 +4,25 @@ import logging
 import logging.config
 import json
 import time
+import asyncio
 from fastapi import Request
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from api.routes import router
+from fastapi.responses import PlainTextResponse
+from api.routes import router, analyze_in_background, retest_in_background
 from models import init_db
 from services.websocket_service import manager
+from services.job_queue import job_queue
+from services.cache_service import evaluation_cache
+from services.rollup_service import ensure_rollups
+from services.search_service import ensure_search_index
+from services.progress_service import progress_tracker
+from services.gemini_scheduler import gemini_scheduler
+from services.pubsub import pubsub
+from services.metrics_service import request_latency, render_metrics
 from config import GEMINI_API_KEY, DATABASE_URL
 
 config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logging_config.json")
@@ -35,6 +45,11 @@ async def log_requests(request: Request, call_next):
     logger.info(f"Входящий запрос: {request.method} {request.url.path} | Origin: {origin}")
     response = await call_next(request)
     process_time = time.time() - start_time
+    # Метка - шаблон маршрута, а не путь: /api/calls/{call_id} вместо тысяч отдельных серий
+    route = request.scope.get("route")
+    request_latency.observe(
+        process_time, method=request.method, route=route.path if route else "unmatched", status=response.status_code
+    )
     logger.info(f"Запрос {request.method} {request.url.path} выполнен за {process_time:.2f}с, статус: {response.status_code}")
     return response
 
@@ -50,12 +65,41 @@ app.include_router(router, prefix="/api", tags=["api"])
 
 @app.websocket("/ws/analyze/{call_id}")
 async def websocket_analyze(websocket: WebSocket, call_id: int):
-    await manager.connect(websocket, call_id)
+    subscriber = await manager.connect(websocket, call_id)
+    sender = asyncio.create_task(manager.pump(websocket, subscriber))
     try:
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        manager.disconnect(websocket, call_id)
+        pass
+    finally:
+        sender.cancel()
+        manager.disconnect(subscriber)
+        logger.info(f"WebSocket отключен для звонка {call_id}")
+
+@app.websocket("/ws/progress")
+async def websocket_progress(websocket: WebSocket):
+    # Один сокет на много звонков: {"action": "subscribe"|"unsubscribe", "call_ids": [...], "manager": "..."}
+    subscriber = await manager.connect(websocket)
+    sender = asyncio.create_task(manager.pump(websocket, subscriber))
+    try:
+        call_ids = [value for value in websocket.query_params.get("call_ids", "").split(",") if value.strip()]
+        managers = websocket.query_params.getlist("manager")
+        if call_ids or managers:
+            reply = await manager.handle_command(subscriber, {"action": "subscribe", "call_ids": call_ids, "managers": managers})
+            subscriber.offer(reply)
+        while True:
+            try:
+                command = await websocket.receive_json()
+            except ValueError:
+                subscriber.offer({"type": "error", "detail": "Ожидается JSON"})
+                continue
+            subscriber.offer(await manager.handle_command(subscriber, command))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        manager.disconnect(subscriber)
 
 @app.on_event("startup")
 async def startup_event():
@@ -72,16 +116,29 @@ async def startup_event():
         
         init_db()
         logger.info("База данных инициализирована")
-        import asyncio
+        evaluation_cache.purge_stale_versions()
+        ensure_rollups()
+        ensure_search_index()
         try:
             loop = asyncio.get_running_loop()
         except RuntimeError:
             loop = asyncio.get_event_loop()
         manager.set_event_loop(loop)
+        # Локальный backend ждет подключения к брокеру до 5 секунд - не на event loop
+        await asyncio.to_thread(pubsub.start)
+        progress_tracker.start()
+        job_queue.start({"analysis": analyze_in_background, "retest": retest_in_background})
     except Exception as e:
         logger.error(f"Ошибка инициализации БД: {e}")
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    job_queue.stop()
+    gemini_scheduler.stop()
+    progress_tracker.stop()
+    await asyncio.to_thread(pubsub.stop)
+
 @app.get("/")
 def read_root():
     return {"message": "AI Coach API", "status": "ok"}
@@ -90,6 +147,10 @@ def read_root():
 def health_check():
     return {"status": "healthy"}
 
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/health")
 def api_health_check():
     return {"status": "healthy", "message": "AI Coach API is running"}
@@ -0,0 +1,28 @@
+"""baseline
+
+Схема на момент перехода на Alembic: таблицы calls, evaluations, analysis_jobs и cache_entries
+со всеми колонками, которые добавляет migrate_db. Существующие базы привязываются к этой
+ревизии через stamp, в пустой базе схема создается по текущим моделям, поэтому последующие
+ревизии проверяют наличие своих объектов перед созданием.
+
+Revision ID: 0001_baseline
+Revises:
+Create Date: 2026-10-18 12:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001_baseline"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    from models import Base
+    
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table("calls"):
+        Base.metadata.create_all(bind=bind)
+
+def downgrade():
+    pass
@@ -0,0 +1,41 @@
+"""query indexes
+
+Составные индексы под запросы из api/routes.py и services/: пагинация списка звонков,
+фильтр по менеджеру и дате звонка, история оценок звонка, выборка задач очереди и
+вытеснение из кеша.
+
+Revision ID: 0002_query_indexes
+Revises: 0001_baseline
+Create Date: 2026-10-18 12:10:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002_query_indexes"
+down_revision = "0001_baseline"
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_calls_created_at_id", "calls", ["created_at", "id"]),
+    ("ix_calls_manager_created_at_id", "calls", ["manager", "created_at", "id"]),
+    ("ix_calls_call_date", "calls", ["call_date"]),
+    ("ix_evaluations_call_id_created_at", "evaluations", ["call_id", "created_at"]),
+    ("ix_analysis_jobs_status_id", "analysis_jobs", ["status", "id"]),
+    ("ix_cache_entries_namespace_last_used_at", "cache_entries", ["namespace", "last_used_at"]),
+]
+
+def existing_indexes(table: str) -> set:
+    inspector = sa.inspect(op.get_bind())
+    return {index["name"] for index in inspector.get_indexes(table)}
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        # Новые базы получают индексы сразу из create_all
+        if name not in existing_indexes(table):
+            op.create_index(name, table, columns)
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        if name in existing_indexes(table):
+            op.drop_index(name, table_name=table)
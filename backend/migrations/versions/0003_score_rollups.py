@@ -0,0 +1,40 @@
+"""score rollups
+
+Таблица предрасчитанных агрегатов оценок по менеджеру и неделе/месяцу для /api/analytics.
+Заполняется при старте приложения, если пуста, и далее обновляется при каждой записи оценки.
+
+Revision ID: 0003_score_rollups
+Revises: 0002_query_indexes
+Create Date: 2026-10-18 13:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003_score_rollups"
+down_revision = "0002_query_indexes"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table("score_rollups"):
+        return
+    op.create_table(
+        "score_rollups",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("manager", sa.String(), nullable=False),
+        sa.Column("period_type", sa.String(), nullable=False),
+        sa.Column("period_start", sa.Date(), nullable=False),
+        sa.Column("calls_count", sa.Integer()),
+        sa.Column("violations_count", sa.Integer()),
+        sa.Column("total_sum", sa.Integer()),
+        sa.Column("total_count", sa.Integer()),
+        sa.Column("criteria_sums", sa.JSON()),
+        sa.Column("criteria_counts", sa.JSON()),
+        sa.Column("updated_at", sa.DateTime()),
+        sa.UniqueConstraint("period_type", "period_start", "manager", name="uq_score_rollups_period_manager"),
+    )
+    op.create_index("ix_score_rollups_id", "score_rollups", ["id"])
+
+def downgrade():
+    op.drop_index("ix_score_rollups_id", table_name="score_rollups")
+    op.drop_table("score_rollups")
@@ -0,0 +1,27 @@
+"""call search
+
+Полнотекстовый индекс по транскрипциям и комментариям оценок: FTS5 в SQLite (в индекс
+пишутся основы слов после русского стеммера), tsvector с конфигурацией russian и GIN в Postgres.
+Заполняется при старте приложения, если пуст.
+
+Revision ID: 0004_call_search
+Revises: 0003_score_rollups
+Create Date: 2026-10-18 14:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from services.search_service import search_ddl
+
+revision = "0004_call_search"
+down_revision = "0003_score_rollups"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    bind = op.get_bind()
+    for statement in search_ddl(bind.dialect.name):
+        op.execute(statement)
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS call_search")
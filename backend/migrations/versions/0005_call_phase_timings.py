@@ -0,0 +1,38 @@
+"""call phase timings
+
+Длительности фаз анализа каждого звонка (загрузка аудио, ожидание обработки в Gemini,
+генерация, оценка, разбор ответа) для последующего анализа задержек.
+
+Revision ID: 0005_call_phase_timings
+Revises: 0004_call_search
+Create Date: 2026-10-18 15:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005_call_phase_timings"
+down_revision = "0004_call_search"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table("call_phase_timings"):
+        return
+    op.create_table(
+        "call_phase_timings",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("call_id", sa.Integer(), sa.ForeignKey("calls.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("phase", sa.String(), nullable=False),
+        sa.Column("started_at", sa.DateTime()),
+        sa.Column("finished_at", sa.DateTime()),
+        sa.Column("duration", sa.Float()),
+        sa.Column("details", sa.JSON()),
+        sa.Column("created_at", sa.DateTime()),
+    )
+    op.create_index("ix_call_phase_timings_id", "call_phase_timings", ["id"])
+    op.create_index("ix_call_phase_timings_call_id", "call_phase_timings", ["call_id"])
+
+def downgrade():
+    op.drop_index("ix_call_phase_timings_call_id", table_name="call_phase_timings")
+    op.drop_index("ix_call_phase_timings_id", table_name="call_phase_timings")
+    op.drop_table("call_phase_timings")
@@ -0,0 +1,32 @@
+"""analysis job kind
+
+Тип задачи очереди: полный анализ звонка или повторная оценка уже готовой транскрипции,
+и флаг повторной оценки в обход кеша.
+
+Revision ID: 0006_analysis_job_kind
+Revises: 0005_call_phase_timings
+Create Date: 2026-10-18 16:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006_analysis_job_kind"
+down_revision = "0005_call_phase_timings"
+branch_labels = None
+depends_on = None
+
+def existing_columns() -> set:
+    inspector = sa.inspect(op.get_bind())
+    return {column["name"] for column in inspector.get_columns("analysis_jobs")}
+
+def upgrade():
+    columns = existing_columns()
+    if "kind" not in columns:
+        op.add_column("analysis_jobs", sa.Column("kind", sa.String(), server_default="analysis"))
+    if "bypass_cache" not in columns:
+        op.add_column("analysis_jobs", sa.Column("bypass_cache", sa.Boolean(), server_default=sa.false()))
+
+def downgrade():
+    with op.batch_alter_table("analysis_jobs") as batch_op:
+        batch_op.drop_column("bypass_cache")
+        batch_op.drop_column("kind")
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, ForeignKey, JSON, Float
+from sqlalchemy import create_engine, Column, Integer, String, Text, Date, DateTime, Boolean, ForeignKey, JSON, Float, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -16,25 +16,45 @@ except Exception as e:
 
 Base = declarative_base()
 
+# Последняя ревизия, схему которой умеет догонять migrate_db; дальнейшие изменения - только через Alembic
+BASELINE_REVISION = "0001_baseline"
+
 class Call(Base):
     __tablename__ = "calls"
+    __table_args__ = (
+        Index("ix_calls_created_at_id", "created_at", "id"),
+        Index("ix_calls_manager_created_at_id", "manager", "created_at", "id"),
+        Index("ix_calls_call_date", "call_date"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String, nullable=False)
     audio_url = Column(String)
+    audio_hash = Column(String)
     transcription = Column(Text)
     duration = Column(Float)
+    audio_stats = Column(JSON)
     manager = Column(String)
     call_date = Column(DateTime)
     call_identifier = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     status = Column(String, default="pending")
     progress = Column(Integer, default=0)
+    latest_evaluation_id = Column(Integer, ForeignKey("evaluations.id", use_alter=True, name="fk_calls_latest_evaluation_id"))
+    итоговая_оценка = Column(Integer)
+    нарушения = Column(Boolean)
+    
+    evaluations = relationship("Evaluation", back_populates="call", foreign_keys="Evaluation.call_id")
+    latest_evaluation = relationship("Evaluation", foreign_keys=[latest_evaluation_id], viewonly=True)
     
-    evaluations = relationship("Evaluation", back_populates="call")
+    def set_latest_evaluation(self, evaluation):
+        self.latest_evaluation_id = evaluation.id
+        self.итоговая_оценка = evaluation.итоговая_оценка
+        self.нарушения = evaluation.нарушения
 
 class Evaluation(Base):
     __tablename__ = "evaluations"
+    __table_args__ = (Index("ix_evaluations_call_id_created_at", "call_id", "created_at"),)
     
     id = Column(Integer, primary_key=True, index=True)
     call_id = Column(Integer, ForeignKey("calls.id"), nullable=False)
@@ -45,7 +65,75 @@ class Evaluation(Base):
     is_retest = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    call = relationship("Call", back_populates="evaluations")
+    call = relationship("Call", back_populates="evaluations", foreign_keys=[call_id])
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    __table_args__ = (Index("ix_analysis_jobs_status_id", "status", "id"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    call_id = Column(Integer, ForeignKey("calls.id"), nullable=False)
+    audio_path = Column(String, nullable=False)
+    kind = Column(String, default="analysis")
+    bypass_cache = Column(Boolean, default=False)
+    status = Column(String, default="queued")
+    attempts = Column(Integer, default=0)
+    locked_by = Column(String)
+    lease_expires_at = Column(DateTime)
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    
+    call = relationship("Call")
+
+class CacheEntry(Base):
+    __tablename__ = "cache_entries"
+    __table_args__ = (
+        UniqueConstraint("namespace", "cache_key", name="uq_cache_entries_namespace_key"),
+        Index("ix_cache_entries_namespace_last_used_at", "namespace", "last_used_at"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    namespace = Column(String, nullable=False)
+    cache_key = Column(String, nullable=False)
+    version = Column(String)
+    value = Column(Text, nullable=False)
+    size = Column(Integer, default=0)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
+class ScoreRollup(Base):
+    __tablename__ = "score_rollups"
+    __table_args__ = (
+        UniqueConstraint("period_type", "period_start", "manager", name="uq_score_rollups_period_manager"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    manager = Column(String, nullable=False, default="")
+    period_type = Column(String, nullable=False)
+    period_start = Column(Date, nullable=False)
+    calls_count = Column(Integer, default=0)
+    violations_count = Column(Integer, default=0)
+    total_sum = Column(Integer, default=0)
+    total_count = Column(Integer, default=0)
+    criteria_sums = Column(JSON, default=dict)
+    criteria_counts = Column(JSON, default=dict)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class CallPhaseTiming(Base):
+    __tablename__ = "call_phase_timings"
+    __table_args__ = (Index("ix_call_phase_timings_call_id", "call_id"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    call_id = Column(Integer, ForeignKey("calls.id", ondelete="CASCADE"), nullable=False)
+    phase = Column(String, nullable=False)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    duration = Column(Float)
+    details = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 def migrate_db():
     from sqlalchemy import text, inspect
@@ -62,14 +150,96 @@ def migrate_db():
             if 'progress' not in columns:
                 logger.info("Добавление колонки progress в таблицу calls")
                 conn.execute(text("ALTER TABLE calls ADD COLUMN progress INTEGER DEFAULT 0"))
+            
+            if 'audio_hash' not in columns:
+                logger.info("Добавление колонки audio_hash в таблицу calls")
+                conn.execute(text("ALTER TABLE calls ADD COLUMN audio_hash TEXT"))
+            
+            if 'audio_stats' not in columns:
+                logger.info("Добавление колонки audio_stats в таблицу calls")
+                conn.execute(text("ALTER TABLE calls ADD COLUMN audio_stats JSON"))
+            
+            if 'latest_evaluation_id' not in columns:
+                logger.info("Добавление колонки latest_evaluation_id в таблицу calls")
+                conn.execute(text("ALTER TABLE calls ADD COLUMN latest_evaluation_id INTEGER"))
+            
+            if 'итоговая_оценка' not in columns:
+                logger.info("Добавление колонки итоговая_оценка в таблицу calls")
+                conn.execute(text('ALTER TABLE calls ADD COLUMN "итоговая_оценка" INTEGER'))
+            
+            if 'нарушения' not in columns:
+                logger.info("Добавление колонки нарушения в таблицу calls")
+                conn.execute(text('ALTER TABLE calls ADD COLUMN "нарушения" BOOLEAN'))
+            
+            backfilled = conn.execute(text("""
+                UPDATE calls SET latest_evaluation_id = (
+                    SELECT e.id FROM evaluations e
+                    WHERE e.call_id = calls.id
+                    ORDER BY e.created_at DESC, e.id DESC
+                    LIMIT 1
+                )
+                WHERE latest_evaluation_id IS NULL
+                  AND EXISTS (SELECT 1 FROM evaluations e WHERE e.call_id = calls.id)
+            """)).rowcount
+            if backfilled:
+                logger.info(f"Заполнена ссылка на последнюю оценку для звонков: {backfilled}")
+                conn.execute(text("""
+                    UPDATE calls SET
+                        "итоговая_оценка" = (SELECT e."итоговая_оценка" FROM evaluations e WHERE e.id = calls.latest_evaluation_id),
+                        "нарушения" = (SELECT e."нарушения" FROM evaluations e WHERE e.id = calls.latest_evaluation_id)
+                    WHERE latest_evaluation_id IS NOT NULL AND "нарушения" IS NULL
+                """))
+        
+        job_columns = [col['name'] for col in inspector.get_columns('analysis_jobs')]
+        
+        with engine.begin() as conn:
+            if 'locked_by' not in job_columns:
+                logger.info("Добавление колонки locked_by в таблицу analysis_jobs")
+                conn.execute(text("ALTER TABLE analysis_jobs ADD COLUMN locked_by TEXT"))
+            
+            if 'lease_expires_at' not in job_columns:
+                logger.info("Добавление колонки lease_expires_at в таблицу analysis_jobs")
+                conn.execute(text("ALTER TABLE analysis_jobs ADD COLUMN lease_expires_at TIMESTAMP"))
+        
+        cache_columns = [col['name'] for col in inspector.get_columns('cache_entries')]
+        
+        with engine.begin() as conn:
+            if 'version' not in cache_columns:
+                logger.info("Добавление колонки version в таблицу cache_entries")
+                conn.execute(text("ALTER TABLE cache_entries ADD COLUMN version TEXT"))
     except Exception as e:
         logger.error(f"Ошибка при проверке структуры таблицы: {e}")
         raise
 
+def run_migrations():
+    import os
+    from alembic import command
+    from alembic.config import Config
+    from alembic.migration import MigrationContext
+    
+    alembic_cfg = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini"))
+    alembic_cfg.attributes["configure_logger"] = False
+    
+    with engine.connect() as conn:
+        current_revision = MigrationContext.configure(conn).get_current_revision()
+    
+    if current_revision is None:
+        # База создана до перехода на Alembic или только что через create_all: ее схема уже не ниже базовой ревизии,
+        # а ревизии выше базовой сами проверяют, существуют ли создаваемые ими объекты
+        logger.info("Привязка существующей схемы БД к базовой ревизии Alembic")
+        command.stamp(alembic_cfg, BASELINE_REVISION)
+    
+    command.upgrade(alembic_cfg, "head")
+
 def init_db():
+    from sqlalchemy import inspect
+    
+    fresh = not inspect(engine).has_table("calls")
     Base.metadata.create_all(bind=engine)
-    try:
-        migrate_db()
-    except Exception as e:
-        logger.warning(f"Ошибка при миграции БД (возможно таблица не существует): {e}")
+    if not fresh:
+        try:
+            migrate_db()
+        except Exception as e:
+            logger.warning(f"Ошибка при миграции БД (возможно таблица не существует): {e}")
+    run_migrations()
 
@@ -0,0 +1,188 @@
+import logging
+import os
+import re
+import shutil
+import subprocess
+
+from config import (
+    FFMPEG_PATH, SILENCE_NOISE_DB, SILENCE_MIN_DURATION,
+    AUDIO_PREPROCESSING_ENABLED, AUDIO_SAMPLE_RATE, AUDIO_BITRATE,
+    AUDIO_VAD_AGGRESSIVENESS, AUDIO_VAD_PADDING_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+SILENCE_START_RE = re.compile(r"silence_start:\s*(-?\d+(?:\.\d+)?)")
+SILENCE_END_RE = re.compile(r"silence_end:\s*(-?\d+(?:\.\d+)?)")
+
+SPEECH_EXTENSION = ".ogg"
+
+# Агрессивность VAD: (порог тишины в dB, минимальная длительность вырезаемой паузы в секундах)
+VAD_PROFILES = {
+    1: (-45.0, 3.0),
+    2: (-40.0, 2.0),
+    3: (-35.0, 1.0),
+}
+
+def ffmpeg_available() -> bool:
+    return shutil.which(FFMPEG_PATH) is not None
+
+def run_ffmpeg(args: list, timeout: float = 600) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [FFMPEG_PATH, "-hide_banner", "-nostdin", *args],
+        capture_output=True, text=True, timeout=timeout
+    )
+
+def probe_duration(audio_path: str):
+    result = run_ffmpeg(["-i", audio_path], timeout=60)
+    match = DURATION_RE.search(result.stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def detect_silences(audio_path: str, noise_db: float = SILENCE_NOISE_DB, min_duration: float = SILENCE_MIN_DURATION) -> list:
+    result = run_ffmpeg([
+        "-i", audio_path,
+        "-af", f"silencedetect=noise={noise_db}dB:d={min_duration}",
+        "-f", "null", "-"
+    ])
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg silencedetect завершился с ошибкой: {result.stderr[-500:]}")
+
+    silences = []
+    start = None
+    for line in result.stderr.splitlines():
+        start_match = SILENCE_START_RE.search(line)
+        if start_match:
+            start = max(0.0, float(start_match.group(1)))
+            continue
+        end_match = SILENCE_END_RE.search(line)
+        if end_match and start is not None:
+            silences.append((start, float(end_match.group(1))))
+            start = None
+    if start is not None:
+        silences.append((start, None))
+    return silences
+
+def plan_chunks(duration: float, silences: list, chunk_seconds: float, overlap_seconds: float) -> list:
+    if duration <= chunk_seconds:
+        return [(0.0, duration)]
+
+    # Границы кусков ставим в середину ближайшей паузы, чтобы не резать слова
+    search_window = chunk_seconds * 0.2
+    midpoints = [
+        (start + (end if end is not None else duration)) / 2
+        for start, end in silences
+    ]
+    boundaries = [0.0]
+    while duration - boundaries[-1] > chunk_seconds:
+        target = boundaries[-1] + chunk_seconds
+        candidates = [m for m in midpoints if abs(m - target) <= search_window and m > boundaries[-1] + overlap_seconds]
+        boundary = min(candidates, key=lambda m: abs(m - target)) if candidates else target
+        boundaries.append(boundary)
+    boundaries.append(duration)
+
+    chunks = []
+    for index in range(len(boundaries) - 1):
+        start = boundaries[index] - overlap_seconds if index > 0 else 0.0
+        chunks.append((max(0.0, start), boundaries[index + 1]))
+    return chunks
+
+def speech_encode_args() -> list:
+    return [
+        "-vn", "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE),
+        "-c:a", "libopus", "-b:a", AUDIO_BITRATE, "-application", "voip"
+    ]
+
+def extract_segment(audio_path: str, start: float, end: float, output_path: str) -> str:
+    result = run_ffmpeg([
+        "-y", "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", audio_path,
+        *speech_encode_args(), output_path
+    ])
+    if result.returncode != 0 or not os.path.exists(output_path):
+        raise RuntimeError(f"Не удалось вырезать фрагмент {start:.1f}-{end:.1f}с: {result.stderr[-500:]}")
+    return output_path
+
+def speech_segments(duration: float, silences: list, padding: float) -> list:
+    segments = []
+    cursor = 0.0
+    for start, end in silences:
+        end = duration if end is None else min(end, duration)
+        segment_end = min(duration, start + padding)
+        if segment_end > cursor:
+            segments.append((cursor, segment_end))
+        cursor = max(cursor, end - padding)
+    if cursor < duration:
+        segments.append((cursor, duration))
+    return [(start, end) for start, end in segments if end - start > 0.01]
+
+def build_timestamp_map(segments: list) -> list:
+    timestamp_map = []
+    processed = 0.0
+    for start, end in segments:
+        timestamp_map.append({
+            "original_start": round(start, 3),
+            "processed_start": round(processed, 3),
+            "duration": round(end - start, 3)
+        })
+        processed += end - start
+    return timestamp_map
+
+def vad_filter(audio_path: str, duration: float):
+    profile = VAD_PROFILES.get(AUDIO_VAD_AGGRESSIVENESS)
+    if not profile or not duration:
+        return None, None
+    noise_db, min_silence = profile
+    silences = detect_silences(audio_path, noise_db, min_silence)
+    segments = speech_segments(duration, silences, AUDIO_VAD_PADDING_SECONDS)
+    speech_duration = sum(end - start for start, end in segments)
+    # Полностью тихую запись не обрезаем - пусть Gemini сам вернет пустой результат
+    if not segments or duration - speech_duration < 1.0:
+        return None, None
+    expression = "+".join(f"between(t,{start:.3f},{end:.3f})" for start, end in segments)
+    return f"aselect='{expression}',asetpts=N/SR/TB", segments
+
+def preprocessing_settings() -> tuple:
+    # Настройки, от которых зависит звук, попадающий в Gemini: входят в ключ кеша транскрипций
+    if not AUDIO_PREPROCESSING_ENABLED:
+        return ("raw",)
+    return ("opus", AUDIO_SAMPLE_RATE, AUDIO_BITRATE, AUDIO_VAD_AGGRESSIVENESS, AUDIO_VAD_PADDING_SECONDS)
+
+def preprocess_audio(audio_path: str, work_dir: str):
+    stats = {"original_bytes": os.path.getsize(audio_path)}
+    if not AUDIO_PREPROCESSING_ENABLED or not ffmpeg_available():
+        stats["processed_bytes"] = stats["original_bytes"]
+        stats["duration"] = probe_duration(audio_path) if ffmpeg_available() else None
+        return audio_path, stats
+
+    stats["duration"] = probe_duration(audio_path)
+    audio_filter, segments = vad_filter(audio_path, stats["duration"])
+    filter_args = ["-af", audio_filter] if audio_filter else []
+
+    output_path = os.path.join(work_dir, "preprocessed" + SPEECH_EXTENSION)
+    try:
+        result = run_ffmpeg(["-y", "-i", audio_path, *filter_args, *speech_encode_args(), output_path])
+        error = result.stderr[-500:] if result.returncode != 0 or not os.path.exists(output_path) else None
+    except subprocess.TimeoutExpired as e:
+        error = str(e)
+    if error:
+        # Подготовка - только оптимизация: без нее загружаем исходный файл, как раньше
+        logger.warning(f"Не удалось подготовить аудио через ffmpeg, используется исходный файл: {error}")
+        stats["processed_bytes"] = stats["original_bytes"]
+        return audio_path, stats
+
+    stats["processed_bytes"] = os.path.getsize(output_path)
+    stats["processed_duration"] = probe_duration(output_path)
+    if segments:
+        removed = max(0.0, stats["duration"] - sum(end - start for start, end in segments))
+        stats["vad_aggressiveness"] = AUDIO_VAD_AGGRESSIVENESS
+        stats["removed_seconds"] = round(removed, 2)
+        stats["removed_ratio"] = round(removed / stats["duration"], 4)
+        stats["timestamp_map"] = build_timestamp_map(segments)
+    logger.info(
+        f"Аудио подготовлено: {stats['original_bytes']} -> {stats['processed_bytes']} байт, "
+        f"длительность {stats['duration'] or 0:.1f}с -> {stats['processed_duration'] or 0:.1f}с"
+    )
+    return output_path, stats
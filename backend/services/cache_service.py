@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+
+from models import CacheEntry, SessionLocal
+from config import (
+    UPLOAD_CHUNK_SIZE,
+    TRANSCRIPTION_CACHE_ENABLED, TRANSCRIPTION_CACHE_MAX_ENTRIES, TRANSCRIPTION_CACHE_MAX_BYTES,
+    EVALUATION_CACHE_ENABLED, EVALUATION_CACHE_MAX_ENTRIES, EVALUATION_CACHE_MAX_BYTES
+)
+from utils.checklist import get_checklist_version
+
+logger = logging.getLogger(__name__)
+
+def hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def make_cache_key(*parts) -> str:
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+class ResultCache:
+    def __init__(self, namespace: str, enabled: bool, max_entries: int, max_bytes: int, version: str = None):
+        self.namespace = namespace
+        self.version = version
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def _count(self, attr: str, amount: int = 1):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + amount)
+
+    def entry_query(self, db, cache_key: str):
+        return db.query(CacheEntry).filter(
+            CacheEntry.namespace == self.namespace,
+            CacheEntry.cache_key == cache_key
+        )
+
+    def eviction_query(self, db):
+        return db.query(CacheEntry.id, CacheEntry.size).filter(
+            CacheEntry.namespace == self.namespace
+        ).order_by(CacheEntry.last_used_at)
+
+    def get(self, cache_key: str):
+        if not self.enabled:
+            return None
+        db = SessionLocal()
+        try:
+            entry = self.entry_query(db, cache_key).first()
+            if not entry:
+                self._count("misses")
+                return None
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_used_at = datetime.utcnow()
+            db.commit()
+            self._count("hits")
+            return entry.value
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Ошибка чтения кеша {self.namespace}: {e}")
+            self._count("misses")
+            return None
+        finally:
+            db.close()
+
+    def put(self, cache_key: str, value: str):
+        if not self.enabled:
+            return
+        db = SessionLocal()
+        try:
+            entry = self.entry_query(db, cache_key).first()
+            if entry:
+                entry.value = value
+                entry.size = len(value.encode("utf-8"))
+                entry.version = self.version
+                entry.last_used_at = datetime.utcnow()
+            else:
+                db.add(CacheEntry(
+                    namespace=self.namespace,
+                    cache_key=cache_key,
+                    version=self.version,
+                    value=value,
+                    size=len(value.encode("utf-8"))
+                ))
+            db.commit()
+            self._evict(db)
+        except IntegrityError:
+            db.rollback()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Ошибка записи в кеш {self.namespace}: {e}")
+        finally:
+            db.close()
+
+    def _evict(self, db):
+        count, total_size = db.query(
+            func.count(CacheEntry.id), func.coalesce(func.sum(CacheEntry.size), 0)
+        ).filter(CacheEntry.namespace == self.namespace).one()
+        if count <= self.max_entries and total_size <= self.max_bytes:
+            return
+
+        evicted = 0
+        oldest = self.eviction_query(db).yield_per(500)
+        to_delete = []
+        for entry_id, size in oldest:
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            to_delete.append(entry_id)
+            count -= 1
+            total_size -= size or 0
+            evicted += 1
+
+        for start in range(0, len(to_delete), 500):
+            db.query(CacheEntry).filter(
+                CacheEntry.id.in_(to_delete[start:start + 500])
+            ).delete(synchronize_session=False)
+        db.commit()
+        self._count("evictions", evicted)
+        logger.info(f"Из кеша {self.namespace} вытеснено записей: {evicted}")
+
+    def purge_stale_versions(self):
+        if self.version is None:
+            return
+        db = SessionLocal()
+        try:
+            purged = db.query(CacheEntry).filter(
+                CacheEntry.namespace == self.namespace,
+                or_(CacheEntry.version.is_(None), CacheEntry.version != self.version)
+            ).delete(synchronize_session=False)
+            db.commit()
+            if purged:
+                logger.info(f"Из кеша {self.namespace} удалено устаревших записей: {purged}")
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Ошибка очистки кеша {self.namespace}: {e}")
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+transcription_cache = ResultCache(
+    "transcription", TRANSCRIPTION_CACHE_ENABLED, TRANSCRIPTION_CACHE_MAX_ENTRIES, TRANSCRIPTION_CACHE_MAX_BYTES
+)
+evaluation_cache = ResultCache(
+    "evaluation", EVALUATION_CACHE_ENABLED, EVALUATION_CACHE_MAX_ENTRIES, EVALUATION_CACHE_MAX_BYTES,
+    version=get_checklist_version()
+)
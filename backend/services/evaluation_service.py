@@ -1,10 +1,17 @@
 import google.generativeai as genai
+import asyncio
 import json
 import os
+import hashlib
 import logging
 
-from utils.checklist import get_checklist_prompt
+from utils.checklist import get_checklist_prompt, get_checklist_version
 from config import GEMINI_API_KEY, GEMINI_EVALUATION_MODEL
+from services.rate_limiter import evaluation_limiter, estimate_text_tokens, response_tokens
+from services.gemini_retry import call_with_retry_async
+from services.gemini_scheduler import gemini_scheduler
+from services.cache_service import evaluation_cache, make_cache_key
+from services.phase_service import emit
 
 genai.configure(api_key=GEMINI_API_KEY)
 
@@ -27,25 +34,56 @@ def normalize_scores(scores_data: dict) -> dict:
     
     return scores_data
 
-def evaluate_transcription(transcription: str) -> dict:
+def evaluation_cache_key(transcription: str) -> str:
+    return make_cache_key(
+        hashlib.sha256(transcription.encode("utf-8")).hexdigest(),
+        get_checklist_version(),
+        GEMINI_EVALUATION_MODEL
+    )
+
+def evaluate_transcription(transcription: str, use_cache: bool = True, on_progress=None) -> dict:
+    return gemini_scheduler.run(evaluate_transcription_async(transcription, use_cache, on_progress))
+
+async def evaluate_transcription_async(transcription: str, use_cache: bool = True, on_progress=None) -> dict:
     if not transcription or len(transcription.strip()) == 0:
         raise ValueError("Транскрипция пустая. Невозможно провести оценку.")
     
+    cache_key = evaluation_cache_key(transcription)
+    if use_cache:
+        cached = await asyncio.to_thread(evaluation_cache.get, cache_key)
+        if cached:
+            logger.info("Оценка найдена в кеше, Gemini не вызывается")
+            emit(on_progress, "evaluation", "start", cached=True)
+            emit(on_progress, "evaluation", "end", cached=True)
+            return json.loads(cached)
+    
     prompt = get_checklist_prompt()
     full_prompt = f"{prompt}\n\nРасшифровка звонка:\n\n{transcription}\n\nОцени звонок по чек-листу и верни JSON."
     
     try:
         model = genai.GenerativeModel(GEMINI_EVALUATION_MODEL)
-        response = model.generate_content(
-            full_prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0,
-                top_p=1.0,
-                top_k=1,
-                max_output_tokens=8192,
-                response_mime_type="application/json"
-            )
-        )
+        estimated_tokens = estimate_text_tokens(full_prompt, max_output_tokens=2048)
+        
+        async def generate():
+            async with evaluation_limiter.limit_async(estimated_tokens) as usage:
+                response = await model.generate_content_async(
+                    full_prompt,
+                    generation_config=genai.types.GenerationConfig(
+                        temperature=0,
+                        top_p=1.0,
+                        top_k=1,
+                        max_output_tokens=8192,
+                        response_mime_type="application/json"
+                    )
+                )
+                usage["tokens"] = usage_tokens["tokens"] = response_tokens(response, estimated_tokens)
+                return response
+        
+        usage_tokens = {}
+        emit(on_progress, "evaluation", "start", estimated_tokens=estimated_tokens)
+        response = await call_with_retry_async(generate, "evaluation")
+        emit(on_progress, "evaluation", "end", tokens=usage_tokens.get("tokens"))
+        emit(on_progress, "evaluation_parse", "start")
         
         if not response:
             raise Exception("Gemini API вернул пустой ответ при оценке")
@@ -73,6 +111,7 @@ def evaluate_transcription(transcription: str) -> dict:
             raise Exception("Модель вернула пустой словарь оценок")
         
         scores_data = normalize_scores(scores_data)
+        emit(on_progress, "evaluation_parse", "end", criteria=len(scores_data))
         
         logger.info(f"Итоговые баллы: {json.dumps({k: v.get('score', v.get('violation', 'N/A')) for k, v in scores_data.items()}, ensure_ascii=False)}")
         
@@ -106,5 +145,7 @@ def evaluate_transcription(transcription: str) -> dict:
     
     logger.info(f"Итоговая оценка: {total_score}")
     
+    await asyncio.to_thread(evaluation_cache.put, cache_key, json.dumps(result, ensure_ascii=False))
+    
     return result
 
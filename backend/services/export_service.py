@@ -0,0 +1,98 @@
+import logging
+
+from config import EXPORT_BATCH_SIZE, EXPORT_COMPRESSION
+from utils.checklist import get_criteria
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pa_ipc = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+COLUMNAR_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+    "arrow": ("application/vnd.apache.arrow.file", ".arrow"),
+}
+
+def columnar_available() -> bool:
+    return pa is not None
+
+def score_column(key: str) -> str:
+    return "score_" + key.replace(".", "_")
+
+def score_criteria() -> list:
+    return [criterion for criterion in get_criteria() if not criterion["violation"]]
+
+def analytics_schema():
+    fields = [
+        pa.field("call_id", pa.int64(), nullable=False),
+        pa.field("call_identifier", pa.string()),
+        pa.field("manager", pa.string()),
+        pa.field("call_date", pa.timestamp("ms")),
+        pa.field("evaluation_id", pa.int64(), nullable=False),
+        pa.field("evaluation_date", pa.timestamp("ms")),
+        pa.field("duration", pa.float64()),
+    ]
+    for criterion in score_criteria():
+        fields.append(pa.field(score_column(criterion["key"]), pa.int16(), metadata={"name": criterion["name"]}))
+    fields += [
+        pa.field("violation", pa.bool_(), nullable=False),
+        pa.field("total", pa.int16()),
+        pa.field("is_retest", pa.bool_()),
+    ]
+    return pa.schema(fields, metadata={"source": "ai_coach", "checklist": "CHECKLIST"})
+
+def to_score(value):
+    try:
+        return int(value) if value is not None and value != "" else None
+    except (TypeError, ValueError):
+        return None
+
+def analytics_record(call, evaluation) -> dict:
+    scores = evaluation.scores or {}
+    record = {
+        "call_id": call.id,
+        "call_identifier": call.call_identifier,
+        "manager": call.manager,
+        "call_date": call.call_date,
+        "evaluation_id": evaluation.id,
+        "evaluation_date": evaluation.created_at,
+        "duration": call.duration,
+    }
+    for criterion in score_criteria():
+        record[score_column(criterion["key"])] = to_score(scores.get(criterion["key"], {}).get("score"))
+    record["violation"] = bool(evaluation.нарушения or scores.get("9", {}).get("violation", False))
+    record["total"] = to_score(evaluation.итоговая_оценка)
+    record["is_retest"] = evaluation.is_retest
+    return record
+
+def open_writer(output_format: str, path: str, schema):
+    if output_format == "parquet":
+        return pq.ParquetWriter(path, schema, compression=EXPORT_COMPRESSION)
+    options = pa_ipc.IpcWriteOptions(compression=EXPORT_COMPRESSION if EXPORT_COMPRESSION in ("zstd", "lz4") else None)
+    return pa_ipc.new_file(path, schema, options=options)
+
+def write_columnar_export(rows, output_format: str, path: str, batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    schema = analytics_schema()
+    columns = {name: [] for name in schema.names}
+    written = 0
+    writer = open_writer(output_format, path, schema)
+    try:
+        for call, evaluation in rows:
+            for name, value in analytics_record(call, evaluation).items():
+                columns[name].append(value)
+            written += 1
+            if written % batch_size == 0:
+                writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+                columns = {name: [] for name in schema.names}
+        if written % batch_size or not written:
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+    finally:
+        writer.close()
+    logger.info(f"Колоночный экспорт ({output_format}): записано звонков {written}")
+    return written
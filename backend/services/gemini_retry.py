@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+
+from config import (
+    GEMINI_RETRY_MAX_ATTEMPTS, GEMINI_RETRY_BASE_DELAY, GEMINI_RETRY_MAX_DELAY,
+    GEMINI_BREAKER_FAILURE_THRESHOLD, GEMINI_BREAKER_COOLDOWN
+)
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = GEMINI_BREAKER_FAILURE_THRESHOLD, cooldown: float = GEMINI_BREAKER_COOLDOWN):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_count = 0
+        self._open_until = 0.0
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                if now < self._open_until:
+                    return self._open_until - now
+                self.state = "half_open"
+                logger.info("Circuit breaker Gemini: пробный запрос после паузы")
+            if self.state == "half_open":
+                if self._trial_in_progress:
+                    return 1.0
+                self._trial_in_progress = True
+            return 0.0
+
+    async def before_call_async(self) -> bool:
+        # Возвращает True, если этот вызов - пробный запрос полуоткрытого breaker
+        while True:
+            wait = self.wait_time()
+            if wait <= 0:
+                with self._lock:
+                    return self.state == "half_open"
+            await asyncio.sleep(min(wait, 5.0))
+
+    def cancel_trial(self):
+        # Пробный запрос отменен без ответа API: следующий вызов станет новым пробным
+        with self._lock:
+            self._trial_in_progress = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("Circuit breaker Gemini закрыт, API снова отвечает")
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_progress = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.opened_count += 1
+                    logger.warning(f"Circuit breaker Gemini открыт на {self.cooldown:.0f}с после {self.failures} ошибок подряд")
+                self.state = "open"
+                self._open_until = time.monotonic() + self.cooldown
+
+class RetryStats:
+    def __init__(self):
+        self.attempts = {}
+        self.retries = {}
+        self.failures = {}
+        self.rate_limited = {}
+        self.retry_wait_seconds = {}
+        self._lock = threading.Lock()
+
+    def record_attempt(self, operation: str, attempt: int, error: Exception = None, delay: float = 0.0):
+        with self._lock:
+            self.attempts[operation] = self.attempts.get(operation, 0) + 1
+            if attempt > 1:
+                self.retries[operation] = self.retries.get(operation, 0) + 1
+            if error is not None:
+                self.failures[operation] = self.failures.get(operation, 0) + 1
+                if status_code(error) == 429:
+                    self.rate_limited[operation] = self.rate_limited.get(operation, 0) + 1
+            if delay:
+                self.retry_wait_seconds[operation] = self.retry_wait_seconds.get(operation, 0.0) + delay
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "attempts": dict(self.attempts),
+                "retries": dict(self.retries),
+                "failures": dict(self.failures),
+                "rate_limited": dict(self.rate_limited),
+                "retry_wait_seconds": {k: round(v, 3) for k, v in self.retry_wait_seconds.items()}
+            }
+
+# Сообщения ошибок содержат пути к файлам и имена файлов Gemini, поэтому код ищем только в начале сообщения:
+# так его пишут исключения google.api_core ("429 Resource has been exhausted")
+STATUS_PREFIX = re.compile(r"\s*(\d{3})\s")
+
+def status_code(error: Exception):
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    if google_exceptions:
+        for exception_type, status in (
+            (google_exceptions.ResourceExhausted, 429),
+            (google_exceptions.InternalServerError, 500),
+            (google_exceptions.BadGateway, 502),
+            (google_exceptions.ServiceUnavailable, 503),
+            (google_exceptions.GatewayTimeout, 504),
+            (google_exceptions.DeadlineExceeded, 504),
+        ):
+            if isinstance(error, exception_type):
+                return status
+    match = STATUS_PREFIX.match(str(error))
+    if match and int(match.group(1)) in RETRYABLE_STATUS_CODES:
+        return int(match.group(1))
+    return None
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    error_msg = str(error)
+    # Модель недоступна на бесплатном тарифе - повтор не поможет
+    if "limit: 0" in error_msg or "free_tier" in error_msg.lower():
+        return False
+    return status_code(error) in RETRYABLE_STATUS_CODES
+
+def retry_hint(error: Exception):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers and headers.get("Retry-After"):
+        try:
+            return float(headers["Retry-After"])
+        except ValueError:
+            pass
+    error_msg = str(error)
+    match = re.search(r"retry in ([\d.]+)\s*s", error_msg, re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", error_msg)
+    if match:
+        return float(match.group(1))
+    return None
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    ceiling = min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    delay = random.uniform(ceiling / 2, ceiling)
+    hint = retry_hint(error)
+    if hint is not None:
+        delay = max(delay, min(hint, GEMINI_RETRY_MAX_DELAY))
+    return delay
+
+def retry_delay_after(error: Exception, operation: str, attempt: int, max_attempts: int, elapsed: float) -> float:
+    if not is_retryable(error):
+        gemini_breaker.record_success()
+        retry_stats.record_attempt(operation, attempt, error)
+        raise error
+    if status_code(error) == 429:
+        # Квота исчерпана, но API доступен - это не авария
+        gemini_breaker.record_success()
+    else:
+        gemini_breaker.record_failure()
+    if attempt >= max_attempts:
+        retry_stats.record_attempt(operation, attempt, error)
+        logger.error(f"Gemini {operation}: попытка {attempt}/{max_attempts} неудачна за {elapsed:.1f}с, попытки исчерпаны: {error}")
+        raise error
+    delay = backoff_delay(attempt, error)
+    retry_stats.record_attempt(operation, attempt, error, delay)
+    logger.warning(f"Gemini {operation}: попытка {attempt}/{max_attempts} неудачна за {elapsed:.1f}с, повтор через {delay:.1f}с: {error}")
+    return delay
+
+def record_retry_success(operation: str, attempt: int):
+    gemini_breaker.record_success()
+    retry_stats.record_attempt(operation, attempt)
+    if attempt > 1:
+        logger.info(f"Gemini {operation}: успешно с попытки {attempt}")
+
+async def call_with_retry_async(func, operation: str, max_attempts: int = GEMINI_RETRY_MAX_ATTEMPTS):
+    # func - функция без аргументов, возвращающая новую корутину на каждую попытку
+    attempt = 0
+    while True:
+        attempt += 1
+        trial = await gemini_breaker.before_call_async()
+        started = time.monotonic()
+        try:
+            result = await func()
+        except Exception as e:
+            await asyncio.sleep(retry_delay_after(e, operation, attempt, max_attempts, time.monotonic() - started))
+            continue
+        except BaseException:
+            # Отмена (TaskGroup соседнего фрагмента, таймаут) - не ответ API, но пробный запрос надо освободить,
+            # иначе breaker навсегда останется полуоткрытым с занятым пробным запросом
+            if trial:
+                gemini_breaker.cancel_trial()
+            raise
+        record_retry_success(operation, attempt)
+        return result
+
+gemini_breaker = CircuitBreaker()
+retry_stats = RetryStats()
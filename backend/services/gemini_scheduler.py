@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class GeminiScheduler:
+    # Все асинхронные вызовы Gemini выполняются на одном event loop в отдельном потоке:
+    # асинхронный клиент SDK привязывается к циклу, на котором создан, а ожидание ответа не занимает поток
+    def __init__(self):
+        self.submitted = 0
+        self.in_flight = 0
+        self.failed = 0
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                ready = threading.Event()
+                self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="gemini-scheduler", daemon=True)
+                self._thread.start()
+                ready.wait()
+            return self._loop
+
+    def _run_loop(self, ready: threading.Event):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        ready.set()
+        logger.info("Планировщик асинхронных запросов Gemini запущен")
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    async def _track(self, coro):
+        with self._lock:
+            self.in_flight += 1
+        try:
+            return await coro
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def submit(self, coro):
+        loop = self._ensure_loop()
+        with self._lock:
+            self.submitted += 1
+        return asyncio.run_coroutine_threadsafe(self._track(coro), loop)
+
+    def run(self, coro):
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("Синхронное ожидание Gemini из потока планировщика заблокировало бы его event loop")
+        return self.submit(coro).result()
+
+    async def run_async(self, coro):
+        # Для вызова из другого event loop (например, из обработчиков FastAPI)
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def stop(self):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        logger.info("Планировщик асинхронных запросов Gemini остановлен")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._loop is not None,
+                "submitted": self.submitted,
+                "in_flight": self.in_flight,
+                "failed": self.failed
+            }
+
+gemini_scheduler = GeminiScheduler()
@@ -0,0 +1,318 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+
+from models import AnalysisJob, Call, SessionLocal
+from config import (
+    ANALYSIS_WORKERS, ANALYSIS_QUEUE_MAX_SIZE, ANALYSIS_QUEUE_POLL_INTERVAL,
+    ANALYSIS_LEASE_SECONDS, ANALYSIS_HEARTBEAT_INTERVAL, ANALYSIS_MAX_ATTEMPTS, WORKER_ID,
+    GEMINI_TRANSCRIPTION_MAX_CONCURRENCY, GEMINI_EVALUATION_MAX_CONCURRENCY
+)
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+class QueueFullError(Exception):
+    pass
+
+class JobQueue:
+    def __init__(self, workers: int = ANALYSIS_WORKERS, max_size: int = ANALYSIS_QUEUE_MAX_SIZE,
+                 poll_interval: float = ANALYSIS_QUEUE_POLL_INTERVAL):
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = ANALYSIS_LEASE_SECONDS
+        self.heartbeat_interval = ANALYSIS_HEARTBEAT_INTERVAL
+        self.max_attempts = ANALYSIS_MAX_ATTEMPTS
+        self.active_workers = 0
+        self._handlers = {}
+        self._threads = []
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Condition()
+        self._state_lock = threading.Lock()
+
+    def start(self, handlers: dict):
+        if self._threads:
+            return
+        self._handlers = handlers
+        self._stop_event.clear()
+        self.recover()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"analysis-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Очередь анализа запущена, воркеров: {self.workers}")
+        gemini_concurrency = max(GEMINI_TRANSCRIPTION_MAX_CONCURRENCY, GEMINI_EVALUATION_MAX_CONCURRENCY)
+        if self.workers < gemini_concurrency:
+            logger.warning(
+                f"Воркеров анализа ({self.workers}) меньше лимита одновременных запросов к Gemini ({gemini_concurrency}): "
+                f"одновременно анализируется не больше {self.workers} звонков"
+            )
+
+    def stop(self):
+        self._stop_event.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        self._threads = []
+        logger.info("Очередь анализа остановлена")
+
+    def pending_count(self, db) -> int:
+        return db.query(AnalysisJob).filter(AnalysisJob.status.in_(ACTIVE_JOB_STATUSES)).count()
+
+    def has_capacity(self, db, count: int = 1) -> bool:
+        return self.pending_count(db) + count <= self.max_size
+
+    def free_capacity(self, db) -> int:
+        return max(0, self.max_size - self.pending_count(db))
+
+    def active_call_ids_query(self, db):
+        return db.query(AnalysisJob.call_id).filter(AnalysisJob.status.in_(ACTIVE_JOB_STATUSES))
+
+    def active_call_ids(self, db, call_ids: list) -> set:
+        return {row.call_id for row in self.active_call_ids_query(db).filter(AnalysisJob.call_id.in_(call_ids))}
+
+    def active_job(self, db, call_id: int):
+        return db.query(AnalysisJob).filter(
+            AnalysisJob.call_id == call_id,
+            AnalysisJob.status.in_(ACTIVE_JOB_STATUSES),
+            or_(AnalysisJob.kind.is_(None), AnalysisJob.kind == "analysis")
+        ).order_by(AnalysisJob.id).first()
+
+    def enqueue(self, db, call_id: int, audio_path: str) -> AnalysisJob:
+        # Повторный запрос анализа (двойной клик, анализ сразу после загрузки) не создает вторую задачу:
+        # два воркера транскрибировали бы и оценивали один звонок параллельно
+        existing = self.active_job(db, call_id)
+        if existing:
+            logger.info(f"Для звонка {call_id} уже есть активная задача {existing.id}, новая не создается")
+            return existing
+
+        if not self.has_capacity(db):
+            raise QueueFullError(f"Очередь анализа заполнена ({self.max_size} задач)")
+
+        job = AnalysisJob(call_id=call_id, audio_path=audio_path, status="queued")
+        db.add(job)
+        call = db.query(Call).filter(Call.id == call_id).first()
+        if call:
+            call.status = "queued"
+            call.progress = 0
+        db.commit()
+        db.refresh(job)
+        logger.info(f"Задача {job.id} для звонка {call_id} поставлена в очередь")
+
+        with self._wakeup:
+            self._wakeup.notify()
+        return job
+
+    def enqueue_retests(self, db, calls: list, bypass_cache: bool = False) -> list:
+        # Ставим столько, сколько помещается: остаток вызывающий дозапрашивает, когда очередь разгрузится
+        free = self.free_capacity(db)
+        if not free:
+            raise QueueFullError(f"Очередь анализа заполнена ({self.max_size} задач)")
+        # Звонок с задачей в очереди или в работе пропускаем: две оценки одного звонка гонялись бы за последнюю оценку
+        busy = self.active_call_ids(db, [call_id for call_id, _ in calls])
+        calls = [(call_id, audio_url) for call_id, audio_url in calls if call_id not in busy][:free]
+
+        # Статус звонка не трогаем: у него уже есть оценка, и recover не должен принять его за незавершенный анализ
+        jobs = [
+            AnalysisJob(call_id=call_id, audio_path=audio_url or "", kind="retest", bypass_cache=bypass_cache, status="queued")
+            for call_id, audio_url in calls
+        ]
+        db.add_all(jobs)
+        db.commit()
+        logger.info(f"В очередь поставлено повторных оценок: {len(jobs)}")
+
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return jobs
+
+    def recover(self):
+        db = SessionLocal()
+        try:
+            active_call_ids = {
+                row.call_id for row in
+                db.query(AnalysisJob.call_id).filter(AnalysisJob.status.in_(ACTIVE_JOB_STATUSES)).all()
+            }
+            stuck_calls = db.query(Call).filter(Call.status.in_(("queued", "processing"))).all()
+            requeued_calls = 0
+            for call in stuck_calls:
+                if call.id in active_call_ids or not call.audio_url:
+                    continue
+                db.add(AnalysisJob(call_id=call.id, audio_path=call.audio_url, status="queued"))
+                call.status = "queued"
+                call.progress = 0
+                requeued_calls += 1
+
+            db.commit()
+            if requeued_calls:
+                logger.info(f"Поставлено в очередь звонков без активной задачи: {requeued_calls}")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка восстановления очереди анализа: {e}")
+        finally:
+            db.close()
+
+    def _claimable_filter(self, now: datetime):
+        expired_lease = and_(
+            AnalysisJob.status == "running",
+            or_(AnalysisJob.lease_expires_at.is_(None), AnalysisJob.lease_expires_at < now)
+        )
+        return or_(AnalysisJob.status == "queued", expired_lease)
+
+    def claim_query(self, db, now: datetime):
+        return db.query(AnalysisJob).filter(self._claimable_filter(now)).order_by(AnalysisJob.id)
+
+    def _claim_next(self, worker_id: str):
+        db = SessionLocal()
+        try:
+            if db.bind.dialect.name == "postgresql":
+                return self._claim_skip_locked(db, worker_id)
+            return self._claim_compare_and_set(db, worker_id)
+        finally:
+            db.close()
+
+    def _claim_skip_locked(self, db, worker_id: str):
+        while True:
+            now = datetime.utcnow()
+            job = self.claim_query(db, now).with_for_update(skip_locked=True).first()
+            if not job:
+                db.rollback()
+                return None
+            if self._exhausted(job):
+                db.commit()
+                continue
+            self._take_lease(job, worker_id, now)
+            db.commit()
+            return job.id, job.call_id, self._job_options(job)
+
+    def _claim_compare_and_set(self, db, worker_id: str):
+        while True:
+            now = datetime.utcnow()
+            job = self.claim_query(db, now).first()
+            if not job:
+                db.rollback()
+                return None
+            if self._exhausted(job):
+                db.commit()
+                continue
+            claimed = db.query(AnalysisJob).filter(
+                AnalysisJob.id == job.id,
+                self._claimable_filter(now),
+                AnalysisJob.attempts == job.attempts
+            ).update({
+                AnalysisJob.status: "running",
+                AnalysisJob.attempts: (job.attempts or 0) + 1,
+                AnalysisJob.locked_by: worker_id,
+                AnalysisJob.lease_expires_at: now + timedelta(seconds=self.lease_seconds),
+                AnalysisJob.started_at: now,
+            }, synchronize_session=False)
+            db.commit()
+            if claimed == 1:
+                return job.id, job.call_id, self._job_options(job)
+            db.expire_all()
+
+    def _job_options(self, job: AnalysisJob):
+        # Задачи, созданные до появления поля kind, - это полный анализ
+        kind = job.kind or "analysis"
+        if kind == "retest":
+            return kind, {"bypass_cache": bool(job.bypass_cache)}
+        return kind, {"audio_path": job.audio_path}
+
+    def _take_lease(self, job: AnalysisJob, worker_id: str, now: datetime):
+        job.status = "running"
+        job.attempts = (job.attempts or 0) + 1
+        job.locked_by = worker_id
+        job.lease_expires_at = now + timedelta(seconds=self.lease_seconds)
+        job.started_at = now
+
+    def _exhausted(self, job: AnalysisJob) -> bool:
+        if job.status != "running" or (job.attempts or 0) < self.max_attempts:
+            return False
+        logger.error(f"Задача {job.id} (звонок {job.call_id}) исчерпала попытки после потери аренды воркером {job.locked_by}")
+        job.status = "failed"
+        job.error = f"Воркер {job.locked_by} не завершил задачу за {job.attempts} попыток"
+        job.finished_at = datetime.utcnow()
+        job.lease_expires_at = None
+        call = job.call
+        if call and job.kind != "retest":
+            call.status = "failed"
+        return True
+
+    def _heartbeat(self, job_id: int, worker_id: str, done: threading.Event):
+        while not done.wait(self.heartbeat_interval):
+            db = SessionLocal()
+            try:
+                extended = db.query(AnalysisJob).filter(
+                    AnalysisJob.id == job_id,
+                    AnalysisJob.locked_by == worker_id,
+                    AnalysisJob.status == "running"
+                ).update({
+                    AnalysisJob.lease_expires_at: datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+                }, synchronize_session=False)
+                db.commit()
+                if not extended:
+                    logger.warning(f"Аренда задачи {job_id} потеряна воркером {worker_id}")
+                    return
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Ошибка продления аренды задачи {job_id}: {e}")
+            finally:
+                db.close()
+
+    def _finish(self, job_id: int, worker_id: str, error: str = None):
+        db = SessionLocal()
+        try:
+            finished = db.query(AnalysisJob).filter(
+                AnalysisJob.id == job_id,
+                AnalysisJob.locked_by == worker_id
+            ).update({
+                AnalysisJob.status: "failed" if error else "done",
+                AnalysisJob.error: error,
+                AnalysisJob.finished_at: datetime.utcnow(),
+                AnalysisJob.lease_expires_at: None,
+            }, synchronize_session=False)
+            db.commit()
+            if not finished:
+                logger.warning(f"Задача {job_id} была перехвачена другим воркером, результат воркера {worker_id} не записан")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка обновления статуса задачи {job_id}: {e}")
+        finally:
+            db.close()
+
+    def _worker_loop(self):
+        worker_id = f"{WORKER_ID}:{threading.current_thread().name}"
+        while not self._stop_event.is_set():
+            try:
+                claimed = self._claim_next(worker_id)
+            except Exception as e:
+                logger.error(f"Ошибка получения задачи из очереди: {e}")
+                claimed = None
+
+            if not claimed:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=self.poll_interval)
+                continue
+
+            job_id, call_id, (kind, options) = claimed
+            with self._state_lock:
+                self.active_workers += 1
+            logger.info(f"Воркер {worker_id} взял задачу {job_id} ({kind}, звонок {call_id})")
+            heartbeat_done = threading.Event()
+            threading.Thread(
+                target=self._heartbeat, args=(job_id, worker_id, heartbeat_done), daemon=True
+            ).start()
+            try:
+                # Запросы к Gemini выполняются на event loop планировщика, но поток воркера ждет их до конца задачи
+                self._handlers[kind](call_id, **options)
+                self._finish(job_id, worker_id)
+            except Exception as e:
+                logger.error(f"Задача {job_id} завершилась с ошибкой: {e}")
+                self._finish(job_id, worker_id, str(e))
+            finally:
+                heartbeat_done.set()
+                with self._state_lock:
+                    self.active_workers -= 1
+
+job_queue = JobQueue()
@@ -0,0 +1,157 @@
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + "}"
+
+def format_value(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+class Histogram:
+    def __init__(self, name: str, description: str, labelnames: tuple, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            if index < len(self.buckets):
+                series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: {**value, "buckets": list(value["buckets"])} for key, value in self._series.items()}
+        for key, value in sorted(series.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, value["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': format_value(float(bound))})} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {value['count']}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(value['sum'])}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {value['count']}")
+        return lines
+
+request_latency = Histogram(
+    "http_request_duration_seconds", "Время обработки HTTP запроса", ("method", "route", "status"), REQUEST_BUCKETS
+)
+stage_latency = Histogram(
+    "analysis_stage_duration_seconds", "Длительность фазы анализа звонка", ("stage",), STAGE_BUCKETS
+)
+
+def metric(name: str, kind: str, description: str, samples: list) -> list:
+    # samples - список пар (метки, значение)
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{format_labels(labels)} {format_value(value)}" for labels, value in samples)
+    return lines
+
+def per_operation(values: dict) -> list:
+    return [({"operation": operation}, value) for operation, value in sorted(values.items())]
+
+def queue_depth() -> list:
+    from sqlalchemy import func
+    from models import AnalysisJob, SessionLocal
+    from services.job_queue import ACTIVE_JOB_STATUSES
+
+    db = SessionLocal()
+    try:
+        rows = db.query(
+            AnalysisJob.status, AnalysisJob.kind, func.count(AnalysisJob.id)
+        ).filter(AnalysisJob.status.in_(ACTIVE_JOB_STATUSES)).group_by(AnalysisJob.status, AnalysisJob.kind).all()
+    finally:
+        db.close()
+    return [({"status": status, "kind": kind or "analysis"}, count) for status, kind, count in rows]
+
+def render_metrics() -> str:
+    # Сервисы импортируются здесь: phase_service сам пишет в stage_latency и импортирует этот модуль
+    from services.job_queue import job_queue
+    from services.cache_service import transcription_cache, evaluation_cache
+    from services.gemini_retry import retry_stats, gemini_breaker
+    from services.rate_limiter import transcription_limiter, evaluation_limiter
+    from services.transcription_service import poll_stats
+    from services.gemini_scheduler import gemini_scheduler
+    from services.websocket_service import manager
+    from services.pubsub import pubsub
+    from services.progress_service import progress_tracker
+
+    lines = request_latency.render() + stage_latency.render()
+
+    try:
+        lines += metric("analysis_queue_jobs", "gauge", "Задачи в очереди анализа по статусу", queue_depth())
+    except Exception as e:
+        logger.warning(f"Не удалось получить глубину очереди для метрик: {e}")
+    lines += metric("analysis_workers_active", "gauge", "Воркеры, выполняющие задачу", [({}, job_queue.active_workers)])
+    lines += metric("analysis_workers", "gauge", "Всего воркеров очереди анализа", [({}, job_queue.workers)])
+
+    retries = retry_stats.snapshot()
+    lines += metric("gemini_requests_total", "counter", "Попытки запросов к Gemini", per_operation(retries["attempts"]))
+    lines += metric("gemini_retries_total", "counter", "Повторные попытки запросов к Gemini", per_operation(retries["retries"]))
+    lines += metric("gemini_errors_total", "counter", "Ошибки запросов к Gemini", per_operation(retries["failures"]))
+    lines += metric("gemini_rate_limited_total", "counter", "Ответы Gemini 429", per_operation(retries["rate_limited"]))
+    lines += metric(
+        "gemini_retry_wait_seconds_total", "counter", "Суммарная пауза backoff перед повторами",
+        per_operation(retries["retry_wait_seconds"])
+    )
+    lines += metric("gemini_circuit_open", "gauge", "Circuit breaker Gemini открыт", [({}, gemini_breaker.state != "closed")])
+
+    limiters = {"transcription": transcription_limiter.stats(), "evaluation": evaluation_limiter.stats()}
+    lines += metric(
+        "gemini_in_flight", "gauge", "Запросы к Gemini в работе",
+        [({"model": name}, stats["in_flight"]) for name, stats in limiters.items()]
+    )
+    lines += metric(
+        "gemini_quota_wait_seconds_total", "counter", "Суммарное ожидание квоты RPM/TPM",
+        [({"model": name}, stats["wait_seconds"]) for name, stats in limiters.items()]
+    )
+
+    polling = poll_stats.snapshot()
+    lines += metric("gemini_file_polls_total", "counter", "Проверки статуса файлов в Gemini", [({}, polling["polls"])])
+    lines += metric("gemini_file_wait_seconds_total", "counter", "Суммарное ожидание обработки файлов", [({}, polling["wait_seconds"])])
+    lines += metric("gemini_file_timeouts_total", "counter", "Файлы, не обработанные в срок", [({}, polling["timeouts"])])
+    lines += metric("gemini_scheduler_in_flight", "gauge", "Корутины на event loop планировщика Gemini", [({}, gemini_scheduler.stats()["in_flight"])])
+
+    caches = {"transcription": transcription_cache.stats(), "evaluation": evaluation_cache.stats()}
+    lines += metric("cache_hits_total", "counter", "Попадания в кеш", [({"cache": name}, stats["hits"]) for name, stats in caches.items()])
+    lines += metric("cache_misses_total", "counter", "Промахи кеша", [({"cache": name}, stats["misses"]) for name, stats in caches.items()])
+    lines += metric("cache_hit_ratio", "gauge", "Доля попаданий в кеш", [({"cache": name}, stats["hit_ratio"]) for name, stats in caches.items()])
+
+    connections = manager.stats()
+    lines += metric("progress_connections", "gauge", "Подключенные клиенты WebSocket и SSE", [({}, connections["connections"])])
+    lines += metric("progress_watched_calls", "gauge", "Звонки, на которые подписан хотя бы один клиент", [({}, connections["watched_calls"])])
+
+    messages = pubsub.stats()
+    lines += metric("pubsub_published_total", "counter", "Опубликованные сообщения прогресса", [({"backend": messages["backend"]}, messages["published"])])
+    lines += metric("pubsub_received_total", "counter", "Полученные сообщения прогресса", [({"backend": messages["backend"]}, messages["received"])])
+
+    progress = progress_tracker.stats()
+    lines += metric("progress_tracked_calls", "gauge", "Звонки с прогрессом в памяти", [({}, progress["tracked_calls"])])
+    lines += metric("progress_pending_writes", "gauge", "Звонки с незаписанным в БД прогрессом", [({}, progress["pending_writes"])])
+    lines += metric("progress_db_flushes_total", "counter", "Пачки записи прогресса в БД", [({}, progress["flushes"])])
+
+    return "\n".join(lines) + "\n"
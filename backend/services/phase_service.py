@@ -0,0 +1,152 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from models import CallPhaseTiming
+from config import TRANSCRIPTION_CHUNKING_ENABLED, TRANSCRIPTION_CHUNK_SECONDS, TRANSCRIPTION_CHUNK_CONCURRENCY
+from services.metrics_service import stage_latency
+from services.progress_service import progress_tracker
+
+logger = logging.getLogger(__name__)
+
+# Фазы анализа по порядку: (процент прогресса в начале фазы, сообщение)
+PHASES = {
+    "preprocess": (12, "Подготовка аудио..."),
+    "upload": (15, "Загрузка аудио в Gemini..."),
+    "processing": (25, "Gemini обрабатывает файл..."),
+    "generation": (40, "Транскрипция..."),
+    "save": (90, "Транскрипция завершена, сохранение..."),
+    "evaluation": (95, "Оценка транскрипции..."),
+    "evaluation_parse": (98, "Разбор результатов оценки..."),
+    "evaluation_save": (99, "Сохранение оценки..."),
+}
+PHASE_ORDER = list(PHASES)
+# Фазы, которые при разбиении длинной записи выполняются для каждого фрагмента параллельно
+CHUNKED_PHASES = ("upload", "processing", "generation")
+GENERATION_PROGRESS_END = 85
+
+def emit(on_progress, phase: str, state: str, **details):
+    if on_progress is None:
+        return
+    try:
+        on_progress(phase, state, **details)
+    except Exception as e:
+        logger.warning(f"Ошибка обработчика прогресса фазы {phase}: {e}")
+
+class PhaseStats:
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self._seconds = {}
+        self._per_audio_second = {}
+        self._lock = threading.Lock()
+
+    def _ewma(self, values: dict, phase: str, value: float):
+        values[phase] = value if phase not in values else values[phase] + self.alpha * (value - values[phase])
+
+    def observe(self, phase: str, duration: float, audio_duration: float = None):
+        with self._lock:
+            self._ewma(self._seconds, phase, duration)
+            if audio_duration:
+                self._ewma(self._per_audio_second, phase, duration / audio_duration)
+
+    def expected(self, phase: str, audio_duration: float = None, parallelism: int = 1):
+        with self._lock:
+            if audio_duration and phase in self._per_audio_second:
+                return self._per_audio_second[phase] * audio_duration / max(1, parallelism)
+            return self._seconds.get(phase)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {phase: round(seconds, 3) for phase, seconds in self._seconds.items()}
+
+class PhaseRecorder:
+    def __init__(self, call_id: int, audio_duration: float = None):
+        self.call_id = call_id
+        self.audio_duration = audio_duration
+        self.progress = 0
+        self.timings = []
+        self._open = {}
+        self._chunks_done = 0
+        self._chunks = None
+        self._lock = threading.Lock()
+
+    def __call__(self, phase: str, state: str, **details):
+        now = time.monotonic()
+        chunk = details.get("chunk")
+        with self._lock:
+            if details.get("chunks"):
+                self._chunks = details["chunks"]
+            if state == "start":
+                self._open[(phase, chunk)] = (now, datetime.utcnow())
+                progress = PHASES.get(phase, (self.progress, None))[0]
+            else:
+                started, started_at = self._open.pop((phase, chunk), (now, datetime.utcnow()))
+                duration = now - started
+                self.timings.append({
+                    "phase": phase,
+                    "started_at": started_at,
+                    "finished_at": datetime.utcnow(),
+                    "duration": duration,
+                    "details": details or None
+                })
+                if not details.get("cached"):
+                    stage_latency.observe(duration, stage=phase)
+                    chunks = max(1, details.get("chunks", 1))
+                    phase_stats.observe(phase, duration, self.audio_duration / chunks if self.audio_duration else None)
+                progress = self.progress
+                if phase == "generation":
+                    self._chunks_done += 1
+                    share = self._chunks_done / max(1, details.get("chunks", 1))
+                    progress = PHASES["generation"][0] + int((GENERATION_PROGRESS_END - PHASES["generation"][0]) * min(1.0, share))
+            # Фрагменты транскрибируются параллельно, прогресс не должен откатываться назад
+            self.progress = max(self.progress, progress)
+            progress = self.progress
+        progress_tracker.update(
+            self.call_id, progress, "processing", PHASES.get(phase, (None, None))[1],
+            phase=phase, eta_seconds=self.eta(phase, now)
+        )
+
+    @contextmanager
+    def phase(self, phase: str, **details):
+        self(phase, "start", **details)
+        try:
+            yield
+        finally:
+            self(phase, "end", **details)
+
+    def parallelism(self) -> int:
+        # Статистика хранит время на секунду аудио одного фрагмента, а фрагменты идут параллельно
+        chunks = self._chunks
+        if chunks is None:
+            chunks = 1
+            if TRANSCRIPTION_CHUNKING_ENABLED and self.audio_duration and self.audio_duration > TRANSCRIPTION_CHUNK_SECONDS * 1.5:
+                chunks = math.ceil(self.audio_duration / TRANSCRIPTION_CHUNK_SECONDS)
+        return max(1, min(chunks, TRANSCRIPTION_CHUNK_CONCURRENCY))
+
+    def eta(self, current_phase: str, now: float):
+        if current_phase not in PHASE_ORDER:
+            return None
+        remaining = 0.0
+        parallelism = self.parallelism()
+        for phase in PHASE_ORDER[PHASE_ORDER.index(current_phase):]:
+            expected = phase_stats.expected(
+                phase, self.audio_duration, parallelism if phase in CHUNKED_PHASES else 1
+            )
+            if expected is None:
+                return None
+            remaining += expected
+        with self._lock:
+            started = [started for (phase, _), (started, _) in self._open.items() if phase == current_phase]
+        if started:
+            remaining -= now - min(started)
+        return max(0.0, remaining)
+
+    def save(self, db):
+        with self._lock:
+            timings, self.timings = self.timings, []
+        db.add_all([CallPhaseTiming(call_id=self.call_id, **timing) for timing in timings])
+
+phase_stats = PhaseStats()
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from sqlalchemy import and_, bindparam, or_, update
+
+from models import Call, SessionLocal
+from config import PROGRESS_FLUSH_INTERVAL
+from services.websocket_service import manager
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+class ProgressTracker:
+    def __init__(self, flush_interval: float = PROGRESS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self.rows_written = 0
+        self.updates = 0
+        self._state = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._flush_loop, name="progress-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread = None
+        self.flush()
+
+    def update(self, call_id: int, progress: int, status: str = None, message: str = None, persisted: bool = False,
+               phase: str = None, eta_seconds: float = None):
+        with self._lock:
+            previous = self._state.get(call_id)
+            status = status or (previous["status"] if previous else "processing")
+            transition = previous is None or previous["status"] != status
+            self._state[call_id] = {
+                "progress": progress,
+                "status": status,
+                "message": message,
+                "phase": phase,
+                "eta_seconds": eta_seconds,
+                "updated_at": time.time()
+            }
+            self.updates += 1
+            if persisted:
+                self._dirty.discard(call_id)
+            else:
+                self._dirty.add(call_id)
+
+        manager.send_progress_sync(call_id, progress, status, message, phase, eta_seconds)
+
+        # Смена статуса пишется сразу, промежуточные проценты - пачкой раз в flush_interval
+        if transition and not persisted:
+            self.flush([call_id])
+        elif persisted and status in TERMINAL_STATUSES:
+            self.forget(call_id)
+
+    def get(self, call_id: int):
+        with self._lock:
+            state = self._state.get(call_id)
+            return dict(state) if state else None
+
+    def forget(self, call_id: int):
+        with self._lock:
+            self._state.pop(call_id, None)
+            self._dirty.discard(call_id)
+
+    def flush(self, call_ids: list = None):
+        with self._lock:
+            pending = set(self._dirty) if call_ids is None else self._dirty.intersection(call_ids)
+            rows = [
+                {"call_id": call_id, "new_progress": self._state[call_id]["progress"], "new_status": self._state[call_id]["status"]}
+                for call_id in pending
+            ]
+            self._dirty.difference_update(pending)
+        if not rows:
+            return
+
+        db = SessionLocal()
+        try:
+            # Финальный статус звонок получает вместе с сохранением оценки, запоздавшая пачка не должна его перетирать
+            db.execute(
+                update(Call.__table__)
+                .where(Call.id == bindparam("call_id"), or_(Call.status.is_(None), and_(*(Call.status != status for status in TERMINAL_STATUSES))))
+                .values(progress=bindparam("new_progress"), status=bindparam("new_status")),
+                rows
+            )
+            db.commit()
+            with self._lock:
+                self.flushes += 1
+                self.rows_written += len(rows)
+                # Завершенные звонки дальше читаются из БД
+                for row in rows:
+                    state = self._state.get(row["call_id"])
+                    if state and state["status"] in TERMINAL_STATUSES and row["call_id"] not in self._dirty:
+                        del self._state[row["call_id"]]
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка записи прогресса в БД: {e}")
+            with self._lock:
+                self._dirty.update(row["call_id"] for row in rows if row["call_id"] in self._state)
+        finally:
+            db.close()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tracked_calls": len(self._state),
+                "pending_writes": len(self._dirty),
+                "updates": self.updates,
+                "flushes": self.flushes,
+                "rows_written": self.rows_written
+            }
+
+progress_tracker = ProgressTracker()
@@ -0,0 +1,321 @@
+import abc
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import socketserver
+import threading
+
+from config import PUBSUB_BACKEND, PUBSUB_LOCAL_ADDRESS, PUBSUB_LOCAL_CLIENT_QUEUE_SIZE
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_CHANNEL = "call_progress"
+
+class PubSub(abc.ABC):
+    # Издатель не ждет доставки: сообщения уходят из отдельного потока в порядке публикации
+    name = "base"
+
+    def __init__(self):
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+        self._subscribers = {}
+        self._outbox = queue.Queue()
+        self._publisher = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    def subscribe(self, channel: str, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def publish(self, channel: str, message: dict):
+        if not self._publisher:
+            self.start()
+        with self._lock:
+            self.published += 1
+        self._outbox.put((channel, message))
+
+    def start(self):
+        with self._start_lock:
+            if self._publisher:
+                return False
+            self._stop_event.clear()
+            self._publisher = threading.Thread(target=self._publish_loop, name=f"pubsub-{self.name}", daemon=True)
+            self._publisher.start()
+            return True
+
+    def stop(self):
+        self._stop_event.set()
+        self._outbox.put(None)
+        self._publisher = None
+
+    def _publish_loop(self):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                return
+            channel, message = item
+            try:
+                self._send(channel, message)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logger.error(f"Ошибка публикации в канал {channel} ({self.name}): {e}")
+
+    @abc.abstractmethod
+    def _send(self, channel: str, message: dict):
+        pass
+
+    def _deliver(self, channel: str, message: dict):
+        with self._lock:
+            self.received += 1
+            callbacks = list(self._subscribers.get(channel, []))
+        for callback in callbacks:
+            try:
+                callback(message)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика канала {channel}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "published": self.published,
+                "received": self.received,
+                "errors": self.errors,
+                "pending": self._outbox.qsize()
+            }
+
+class MemoryPubSub(PubSub):
+    # Только внутри процесса, как было до появления pub/sub
+    name = "memory"
+
+    def _send(self, channel: str, message: dict):
+        self._deliver(channel, message)
+
+class PostgresPubSub(PubSub):
+    name = "postgres"
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self._publish_conn = None
+        self._listener = None
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        return conn
+
+    def start(self):
+        if not super().start():
+            return False
+        self._listener = threading.Thread(target=self._listen_loop, name="pubsub-postgres-listen", daemon=True)
+        self._listener.start()
+        return True
+
+    def stop(self):
+        super().stop()
+        self._listener = None
+
+    def _send(self, channel: str, message: dict):
+        payload = json.dumps(message, ensure_ascii=False)
+        for attempt in (1, 2):
+            try:
+                if self._publish_conn is None or self._publish_conn.closed:
+                    self._publish_conn = self._connect()
+                with self._publish_conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+                return
+            except psycopg2.OperationalError:
+                # Соединение могло быть закрыто сервером, переподключаемся один раз
+                self._publish_conn = None
+                if attempt == 2:
+                    raise
+
+    def _listen_loop(self):
+        delay = 1.0
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                with conn.cursor() as cursor:
+                    with self._lock:
+                        channels = list(self._subscribers)
+                    for channel in channels:
+                        cursor.execute(f'LISTEN "{channel}"')
+                logger.info(f"Подписка LISTEN на каналы: {', '.join(channels)}")
+                delay = 1.0
+                while not self._stop_event.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._deliver(notify.channel, json.loads(notify.payload))
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logger.error(f"Ошибка LISTEN в Postgres, переподключение через {delay:.0f}с: {e}")
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, 30.0)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+class LocalBrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        broker = self.server
+        # У каждого клиента своя очередь и поток записи: зависший читатель не задерживает рассылку остальным
+        outbox = queue.Queue(maxsize=PUBSUB_LOCAL_CLIENT_QUEUE_SIZE)
+        threading.Thread(target=self._write_loop, args=(outbox,), name="pubsub-local-writer", daemon=True).start()
+        with broker.lock:
+            broker.clients[outbox] = self
+        try:
+            for line in self.rfile:
+                broker.fan_out(line)
+        finally:
+            with broker.lock:
+                broker.clients.pop(outbox, None)
+            try:
+                outbox.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def _write_loop(self, outbox: queue.Queue):
+        while True:
+            line = outbox.get()
+            if line is None:
+                return
+            try:
+                self.wfile.write(line)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                return
+
+    def disconnect(self):
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class LocalBroker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, LocalBrokerHandler)
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def fan_out(self, line: bytes):
+        # Под общей блокировкой только постановка в очереди, поэтому строки от разных отправителей не перемешиваются
+        with self.lock:
+            for outbox, handler in list(self.clients.items()):
+                try:
+                    outbox.put_nowait(line)
+                except queue.Full:
+                    # Клиент не читает: отключаем, после переподключения он продолжит с новых сообщений
+                    logger.warning(f"Клиент локального брокера pub/sub {handler.client_address} не успевает читать, отключен")
+                    del self.clients[outbox]
+                    handler.disconnect()
+
+class LocalPubSub(PubSub):
+    # Легковесный брокер для тестов и локального запуска нескольких воркеров uvicorn:
+    # первый процесс поднимает TCP-брокер на PUBSUB_LOCAL_ADDRESS, остальные подключаются к нему,
+    # брокер рассылает каждую строку JSON всем подключенным, включая отправителя
+    name = "local"
+
+    def __init__(self, address: str):
+        super().__init__()
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.broker = None
+        self._sock = None
+        self._reader = None
+        self._connected = threading.Event()
+
+    def start(self):
+        if not super().start():
+            return False
+        self._reader = threading.Thread(target=self._read_loop, name="pubsub-local-read", daemon=True)
+        self._reader.start()
+        self._connected.wait(timeout=5)
+        return True
+
+    def stop(self):
+        super().stop()
+        self._reader = None
+        if self._sock:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.broker:
+            self.broker.shutdown()
+            self.broker.server_close()
+            self.broker = None
+
+    def _ensure_broker(self):
+        try:
+            self.broker = LocalBroker(self.address)
+        except OSError:
+            # Брокер уже запущен другим процессом
+            return
+        threading.Thread(target=self.broker.serve_forever, name="pubsub-local-broker", daemon=True).start()
+        logger.info(f"Локальный брокер pub/sub запущен на {self.address[0]}:{self.address[1]} (pid {os.getpid()})")
+
+    def _send(self, channel: str, message: dict):
+        if not self._connected.wait(timeout=5):
+            raise ConnectionError("Нет соединения с локальным брокером pub/sub")
+        line = json.dumps({"channel": channel, "message": message}, ensure_ascii=False) + "\n"
+        self._sock.sendall(line.encode("utf-8"))
+
+    def _read_loop(self):
+        delay = 0.5
+        while not self._stop_event.is_set():
+            try:
+                self._ensure_broker()
+                self._sock = socket.create_connection(self.address, timeout=5)
+                self._sock.settimeout(None)
+                self._connected.set()
+                delay = 0.5
+                with self._sock.makefile("rb") as reader:
+                    for line in reader:
+                        envelope = json.loads(line)
+                        self._deliver(envelope["channel"], envelope["message"])
+            except Exception as e:
+                if self._stop_event.is_set():
+                    return
+                logger.warning(f"Соединение с локальным брокером pub/sub потеряно: {e}")
+            self._connected.clear()
+            # Если процесс с брокером завершился, его место займет следующий подключившийся
+            self._stop_event.wait(delay)
+            delay = min(delay * 2, 10.0)
+
+def create_pubsub(backend: str = PUBSUB_BACKEND) -> PubSub:
+    if backend == "postgres":
+        from models import engine
+        if engine.dialect.name != "postgresql":
+            logger.warning("PUBSUB_BACKEND=postgres требует PostgreSQL в DATABASE_URL, используется memory")
+        elif psycopg2 is None:
+            logger.warning("psycopg2 не установлен, PUBSUB_BACKEND=postgres недоступен, используется memory")
+        else:
+            return PostgresPubSub(engine.url.set(drivername="postgresql").render_as_string(hide_password=False))
+    elif backend == "local":
+        return LocalPubSub(PUBSUB_LOCAL_ADDRESS)
+    elif backend != "memory":
+        logger.warning(f"Неизвестный PUBSUB_BACKEND={backend}, используется memory")
+    return MemoryPubSub()
+
+pubsub = create_pubsub()
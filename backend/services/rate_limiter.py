@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import wave
+from contextlib import asynccontextmanager
+
+from config import (
+    GEMINI_TRANSCRIPTION_RPM, GEMINI_TRANSCRIPTION_TPM, GEMINI_TRANSCRIPTION_MAX_CONCURRENCY,
+    GEMINI_EVALUATION_RPM, GEMINI_EVALUATION_TPM, GEMINI_EVALUATION_MAX_CONCURRENCY,
+    GEMINI_AUDIO_TOKENS_PER_SECOND
+)
+from services.audio_service import ffmpeg_available, probe_duration
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def refill(self, now: float):
+        if not self.enabled:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if not self.enabled:
+            return 0.0
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        if self.enabled:
+            self.tokens -= min(amount, self.capacity)
+
+class GeminiRateLimiter:
+    def __init__(self, name: str, rpm: int, tpm: int, max_concurrency: int):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max(1, max_concurrency)
+        self.in_flight = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def try_reserve(self, estimated_tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+            if wait <= 0:
+                self.requests.consume(1)
+                self.tokens.consume(estimated_tokens)
+            return wait
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        if actual_tokens is None or actual_tokens == estimated_tokens:
+            return
+        with self._lock:
+            self.tokens.consume(actual_tokens - estimated_tokens)
+
+    def semaphore(self) -> asyncio.Semaphore:
+        # Все запросы к Gemini идут с event loop планировщика; после его перезапуска семафор создается заново
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def acquire_async(self, semaphore: asyncio.Semaphore, estimated_tokens: int = 0):
+        started = time.monotonic()
+        await semaphore.acquire()
+        try:
+            while True:
+                wait = self.try_reserve(estimated_tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(min(wait, 5.0))
+        except BaseException:
+            # Отмена задачи во время ожидания квоты не должна оставлять занятый слот
+            semaphore.release()
+            raise
+        self._record_acquired(time.monotonic() - started)
+
+    def _record_acquired(self, waited: float):
+        with self._lock:
+            self.in_flight += 1
+            if waited > 0.05:
+                self.waits += 1
+                self.wait_seconds += waited
+        if waited > 1:
+            logger.info(f"Запрос к Gemini ({self.name}) ожидал квоту {waited:.1f}с")
+
+    def release(self, semaphore: asyncio.Semaphore):
+        with self._lock:
+            self.in_flight -= 1
+        semaphore.release()
+
+    @asynccontextmanager
+    async def limit_async(self, estimated_tokens: int = 0):
+        semaphore = self.semaphore()
+        await self.acquire_async(semaphore, estimated_tokens)
+        usage = {"tokens": estimated_tokens}
+        try:
+            yield usage
+        finally:
+            self.release(semaphore)
+            self.settle(estimated_tokens, usage["tokens"])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 3)
+            }
+
+def response_tokens(response, default: int) -> int:
+    usage = getattr(response, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", None) if usage else None
+    return total or default
+
+def estimate_text_tokens(text: str, max_output_tokens: int = 0) -> int:
+    # Кириллица в токенизаторе Gemini занимает примерно 3 символа на токен
+    return len(text) // 3 + max_output_tokens
+
+def estimate_audio_tokens(audio_path: str) -> int:
+    duration = None
+    try:
+        with wave.open(audio_path, "rb") as wav:
+            duration = wav.getnframes() / float(wav.getframerate())
+    except Exception:
+        pass
+    if duration is None and ffmpeg_available():
+        try:
+            duration = probe_duration(audio_path)
+        except Exception:
+            pass
+    if duration is None:
+        # Без ffmpeg оцениваем длительность по размеру при ~128 кбит/с
+        duration = os.path.getsize(audio_path) / 16000
+    # Входные аудио токены плюс примерно 5 токенов текста на секунду речи
+    return int(duration * (GEMINI_AUDIO_TOKENS_PER_SECOND + 5))
+
+transcription_limiter = GeminiRateLimiter(
+    "transcription", GEMINI_TRANSCRIPTION_RPM, GEMINI_TRANSCRIPTION_TPM, GEMINI_TRANSCRIPTION_MAX_CONCURRENCY
+)
+evaluation_limiter = GeminiRateLimiter(
+    "evaluation", GEMINI_EVALUATION_RPM, GEMINI_EVALUATION_TPM, GEMINI_EVALUATION_MAX_CONCURRENCY
+)
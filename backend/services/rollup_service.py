@@ -0,0 +1,145 @@
+import logging
+from datetime import date, datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+
+from models import Call, Evaluation, ScoreRollup, SessionLocal
+from config import EXPORT_BATCH_SIZE
+from services.export_service import score_criteria, to_score
+
+logger = logging.getLogger(__name__)
+
+PERIOD_TYPES = ("week", "month")
+
+def period_start(period_type: str, moment: datetime) -> date:
+    day = moment.date()
+    if period_type == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+def call_moment(call: Call) -> datetime:
+    return call.call_date or call.created_at or datetime.utcnow()
+
+def evaluation_contribution(evaluation: Evaluation) -> dict:
+    scores = evaluation.scores or {}
+    criteria = {}
+    for criterion in score_criteria():
+        score = to_score(scores.get(criterion["key"], {}).get("score"))
+        if score is not None:
+            criteria[criterion["key"]] = score
+    total = to_score(evaluation.итоговая_оценка)
+    return {
+        "violation": bool(evaluation.нарушения or scores.get("9", {}).get("violation", False)),
+        "total": total,
+        "criteria": criteria
+    }
+
+def apply_contribution(rollup: ScoreRollup, contribution: dict, sign: int):
+    rollup.calls_count = (rollup.calls_count or 0) + sign
+    rollup.violations_count = (rollup.violations_count or 0) + (sign if contribution["violation"] else 0)
+    if contribution["total"] is not None:
+        rollup.total_sum = (rollup.total_sum or 0) + sign * contribution["total"]
+        rollup.total_count = (rollup.total_count or 0) + sign
+    # JSON колонки пересобираем целиком, чтобы SQLAlchemy увидел изменение
+    sums = dict(rollup.criteria_sums or {})
+    counts = dict(rollup.criteria_counts or {})
+    for key, score in contribution["criteria"].items():
+        sums[key] = sums.get(key, 0) + sign * score
+        counts[key] = counts.get(key, 0) + sign
+    rollup.criteria_sums = sums
+    rollup.criteria_counts = counts
+    rollup.updated_at = datetime.utcnow()
+
+def get_rollup(db, manager: str, period_type: str, start: date) -> ScoreRollup:
+    query = db.query(ScoreRollup).filter(
+        ScoreRollup.period_type == period_type,
+        ScoreRollup.period_start == start,
+        ScoreRollup.manager == manager
+    )
+    if db.bind.dialect.name == "postgresql":
+        query = query.with_for_update()
+    rollup = query.first()
+    if rollup:
+        return rollup
+    try:
+        with db.begin_nested():
+            rollup = ScoreRollup(manager=manager, period_type=period_type, period_start=start)
+            db.add(rollup)
+        return rollup
+    except IntegrityError:
+        # Строку за тот же период успел создать другой воркер
+        return query.first()
+
+def update_rollups(db, call: Call, evaluation: Evaluation, sign: int):
+    contribution = evaluation_contribution(evaluation)
+    moment = call_moment(call)
+    for period_type in PERIOD_TYPES:
+        rollup = get_rollup(db, call.manager or "", period_type, period_start(period_type, moment))
+        apply_contribution(rollup, contribution, sign)
+
+def record_evaluation(db, call: Call, evaluation: Evaluation, previous: Evaluation = None):
+    # В агрегатах учитывается только последняя оценка звонка: повторная проверка заменяет предыдущую
+    if previous is not None:
+        update_rollups(db, call, previous, -1)
+    update_rollups(db, call, evaluation, 1)
+
+def rebuild_rollups() -> int:
+    db = SessionLocal()
+    try:
+        aggregated = {}
+        rows = db.query(Call, Evaluation).join(
+            Evaluation, Evaluation.id == Call.latest_evaluation_id
+        ).yield_per(EXPORT_BATCH_SIZE)
+        calls = 0
+        for call, evaluation in rows:
+            contribution = evaluation_contribution(evaluation)
+            moment = call_moment(call)
+            for period_type in PERIOD_TYPES:
+                key = (call.manager or "", period_type, period_start(period_type, moment))
+                if key not in aggregated:
+                    aggregated[key] = ScoreRollup(
+                        manager=key[0], period_type=period_type, period_start=key[2],
+                        calls_count=0, violations_count=0, total_sum=0, total_count=0,
+                        criteria_sums={}, criteria_counts={}
+                    )
+                apply_contribution(aggregated[key], contribution, 1)
+            calls += 1
+
+        db.query(ScoreRollup).delete(synchronize_session=False)
+        db.add_all(aggregated.values())
+        db.commit()
+        logger.info(f"Агрегаты оценок пересчитаны: звонков {calls}, строк {len(aggregated)}")
+        return len(aggregated)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def ensure_rollups():
+    db = SessionLocal()
+    try:
+        empty = db.query(ScoreRollup.id).first() is None
+        evaluated = db.query(Call.id).filter(Call.latest_evaluation_id.isnot(None)).first() is not None
+    finally:
+        db.close()
+    if empty and evaluated:
+        logger.info("Таблица агрегатов оценок пуста, выполняется первичный расчет")
+        rebuild_rollups()
+
+def rollup_summary(rollup: ScoreRollup) -> dict:
+    sums = rollup.criteria_sums or {}
+    counts = rollup.criteria_counts or {}
+    return {
+        "manager": rollup.manager or None,
+        "period": rollup.period_type,
+        "period_start": rollup.period_start.isoformat(),
+        "calls": rollup.calls_count,
+        "violations": rollup.violations_count,
+        "violation_rate": round(rollup.violations_count / rollup.calls_count, 4) if rollup.calls_count else 0.0,
+        "average_total": round(rollup.total_sum / rollup.total_count, 2) if rollup.total_count else None,
+        "criteria": {
+            criterion["key"]: round(sums[criterion["key"]] / counts[criterion["key"]], 2)
+            if counts.get(criterion["key"]) else None
+            for criterion in score_criteria()
+        }
+    }
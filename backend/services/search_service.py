@@ -0,0 +1,182 @@
+import json
+import logging
+import re
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload
+
+from models import Call, Evaluation, SessionLocal
+from config import EXPORT_BATCH_SIZE, SEARCH_SNIPPET_WORDS
+from utils.stemmer import stem, stem_text, tokenize
+
+logger = logging.getLogger(__name__)
+
+HIGHLIGHT_START = "<b>"
+HIGHLIGHT_END = "</b>"
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS call_search USING fts5("
+    "transcription_terms, comments_terms, comments UNINDEXED, tokenize = 'unicode61 remove_diacritics 0')",
+]
+
+POSTGRES_DDL = [
+    "CREATE TABLE IF NOT EXISTS call_search ("
+    "call_id INTEGER PRIMARY KEY REFERENCES calls(id) ON DELETE CASCADE, "
+    "document TSVECTOR NOT NULL, "
+    "comments TEXT)",
+    "CREATE INDEX IF NOT EXISTS ix_call_search_document ON call_search USING GIN (document)",
+]
+
+def search_ddl(dialect: str) -> list:
+    return POSTGRES_DDL if dialect == "postgresql" else SQLITE_DDL
+
+def is_postgres(db) -> bool:
+    return db.bind.dialect.name == "postgresql"
+
+def comments_text(raw: str) -> str:
+    # В оценке комментарии хранятся JSON-объектом {"1.1": "...", ...}; в индекс и сниппеты идет только текст
+    if not raw:
+        return ""
+    try:
+        comments = json.loads(raw)
+    except ValueError:
+        return raw
+    if isinstance(comments, dict):
+        comments = comments.values()
+    elif not isinstance(comments, list):
+        return str(comments)
+    return "\n".join(str(comment) for comment in comments if comment)
+
+def index_call(db, call: Call, evaluation: Evaluation = None):
+    # Индексируется только последняя оценка: повторная проверка заменяет старые комментарии, а не дописывает их
+    evaluation = evaluation or call.latest_evaluation
+    comments = comments_text(evaluation.комментарии if evaluation else None)
+    if is_postgres(db):
+        db.execute(text("""
+            INSERT INTO call_search (call_id, document, comments)
+            VALUES (
+                :call_id,
+                setweight(to_tsvector('russian', coalesce(:transcription, '')), 'A')
+                    || setweight(to_tsvector('russian', :comments), 'B'),
+                :comments
+            )
+            ON CONFLICT (call_id) DO UPDATE SET document = EXCLUDED.document, comments = EXCLUDED.comments
+        """), {"call_id": call.id, "transcription": call.transcription, "comments": comments})
+        return
+    # FTS5 не умеет русскую морфологию, поэтому в индекс кладем уже приведенные к основе слова
+    db.execute(text("DELETE FROM call_search WHERE rowid = :call_id"), {"call_id": call.id})
+    db.execute(text("""
+        INSERT INTO call_search (rowid, transcription_terms, comments_terms, comments)
+        VALUES (:call_id, :transcription_terms, :comments_terms, :comments)
+    """), {
+        "call_id": call.id,
+        "transcription_terms": stem_text(call.transcription),
+        "comments_terms": stem_text(comments),
+        "comments": comments
+    })
+
+def rebuild_search_index() -> int:
+    db = SessionLocal()
+    try:
+        db.execute(text("DELETE FROM call_search"))
+        indexed = 0
+        calls = db.query(Call).options(joinedload(Call.latest_evaluation)).filter(Call.transcription.isnot(None))
+        for call in calls.yield_per(EXPORT_BATCH_SIZE):
+            index_call(db, call)
+            indexed += 1
+        db.commit()
+        logger.info(f"Поисковый индекс пересобран, звонков: {indexed}")
+        return indexed
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def ensure_search_index():
+    db = SessionLocal()
+    try:
+        empty = db.execute(text("SELECT 1 FROM call_search LIMIT 1")).first() is None
+        transcribed = db.query(Call.id).filter(Call.transcription.isnot(None)).first() is not None
+    finally:
+        db.close()
+    if empty and transcribed:
+        logger.info("Поисковый индекс пуст, выполняется первичная индексация звонков")
+        rebuild_search_index()
+
+def fts_query(query: str) -> str:
+    # Каждое слово - префиксный поиск по основе, кавычки защищают от синтаксиса FTS5
+    stems = [stem(token) for token in tokenize(query)]
+    return " AND ".join(f'"{term}"*' for term in stems if term)
+
+def highlight(source: str, query: str, max_words: int = SEARCH_SNIPPET_WORDS) -> str:
+    if not source:
+        return ""
+    stems = {stem(token) for token in tokenize(query)}
+    words = list(re.finditer(r"\S+", source))
+    matches = []
+    for index, word in enumerate(words):
+        tokens = tokenize(word.group())
+        if any(stem(token).startswith(term) for token in tokens for term in stems):
+            matches.append(index)
+    if not matches:
+        return ""
+    start = max(0, matches[0] - max_words // 3)
+    end = min(len(words), start + max_words)
+    parts = []
+    for index in range(start, end):
+        word = words[index].group()
+        parts.append(f"{HIGHLIGHT_START}{word}{HIGHLIGHT_END}" if index in matches else word)
+    return ("... " if start > 0 else "") + " ".join(parts) + (" ..." if end < len(words) else "")
+
+def search_calls(db, query: str, manager: str = None, limit: int = 20, offset: int = 0):
+    params = {"manager": manager, "limit": limit, "offset": offset}
+    manager_filter = "AND c.manager = :manager" if manager else ""
+    if is_postgres(db):
+        params["query"] = query
+        headline_options = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords={SEARCH_SNIPPET_WORDS}, MinWords=10"
+        base = f"""
+            FROM call_search s
+            JOIN calls c ON c.id = s.call_id,
+            websearch_to_tsquery('russian', :query) q
+            WHERE s.document @@ q {manager_filter}
+        """
+        total = db.execute(text(f"SELECT count(*) {base}"), params).scalar()
+        rows = db.execute(text(f"""
+            SELECT c.id, ts_rank(s.document, q) AS rank,
+                   ts_headline('russian', coalesce(c.transcription, ''), q, '{headline_options}') AS transcription_highlight,
+                   ts_headline('russian', coalesce(s.comments, ''), q, '{headline_options}') AS comments_highlight
+            {base}
+            ORDER BY rank DESC, c.id DESC
+            LIMIT :limit OFFSET :offset
+        """), params).fetchall()
+        hits = [
+            (row.id, float(row.rank), matched(row.transcription_highlight), matched(row.comments_highlight))
+            for row in rows
+        ]
+        return total, hits
+
+    params["query"] = fts_query(query)
+    if not params["query"]:
+        return 0, []
+    base = f"""
+        FROM call_search s
+        JOIN calls c ON c.id = s.rowid
+        WHERE call_search MATCH :query {manager_filter}
+    """
+    total = db.execute(text(f"SELECT count(*) {base}"), params).scalar()
+    rows = db.execute(text(f"""
+        SELECT c.id, c.transcription, s.comments, bm25(call_search, 1.0, 0.5) AS rank
+        {base}
+        ORDER BY rank, c.id DESC
+        LIMIT :limit OFFSET :offset
+    """), params).fetchall()
+    # bm25 в SQLite тем лучше, чем меньше, приводим к общему виду "больше - релевантнее"
+    hits = [
+        (row.id, -float(row.rank), highlight(row.transcription, query), highlight(row.comments, query))
+        for row in rows
+    ]
+    return total, hits
+
+def matched(headline: str) -> str:
+    # ts_headline возвращает начало текста, даже если совпадение только в другом поле
+    return headline if headline and HIGHLIGHT_START in headline else ""
@@ -1,9 +1,30 @@
 import google.generativeai as genai
+import asyncio
 import os
+import re
 import logging
+import tempfile
+import threading
 import time
+from difflib import SequenceMatcher
 from dotenv import load_dotenv
-from config import GEMINI_API_KEY, GEMINI_TRANSCRIPTION_MODEL
+from config import (
+    GEMINI_API_KEY, GEMINI_TRANSCRIPTION_MODEL,
+    TRANSCRIPTION_CHUNKING_ENABLED, TRANSCRIPTION_CHUNK_SECONDS, TRANSCRIPTION_CHUNK_OVERLAP_SECONDS,
+    TRANSCRIPTION_CHUNK_CONCURRENCY, TRANSCRIPTION_STITCH_WINDOW_WORDS,
+    GEMINI_FILE_POLL_INITIAL_INTERVAL, GEMINI_FILE_POLL_MAX_INTERVAL, GEMINI_FILE_POLL_BACKOFF,
+    GEMINI_FILE_PROCESSING_TIMEOUT, GEMINI_FILE_PROCESSING_TIMEOUT_PER_MB,
+    SILENCE_NOISE_DB, SILENCE_MIN_DURATION
+)
+from services.rate_limiter import transcription_limiter, estimate_audio_tokens, response_tokens
+from services.gemini_retry import call_with_retry_async
+from services.gemini_scheduler import gemini_scheduler
+from services.cache_service import make_cache_key
+from services.phase_service import emit
+from services.audio_service import (
+    ffmpeg_available, probe_duration, detect_silences, plan_chunks, extract_segment, preprocessing_settings,
+    SPEECH_EXTENSION
+)
 
 try:
     from google.api_core import exceptions as google_exceptions
@@ -16,36 +37,129 @@ logger = logging.getLogger(__name__)
 
 genai.configure(api_key=GEMINI_API_KEY)
 
-def transcribe_audio(audio_path: str) -> str:
-    logger.info(f"Начало транскрипции файла: {audio_path}")
-    
-    if not os.path.exists(audio_path):
-        raise FileNotFoundError(f"Аудио файл не найден: {audio_path}")
+TRANSCRIPTION_PROMPT = "Транскрибируй этот аудио файл на русском языке. Верни только текст без дополнительных комментариев."
+
+def transcription_cache_key(audio_hash: str) -> str:
+    # Текст зависит не только от файла: VAD вырезает паузы, а длинные записи режутся на куски и склеиваются
+    chunking = (
+        (TRANSCRIPTION_CHUNK_SECONDS, TRANSCRIPTION_CHUNK_OVERLAP_SECONDS, TRANSCRIPTION_STITCH_WINDOW_WORDS,
+         SILENCE_NOISE_DB, SILENCE_MIN_DURATION)
+        if TRANSCRIPTION_CHUNKING_ENABLED else ("whole",)
+    )
+    return make_cache_key(audio_hash, GEMINI_TRANSCRIPTION_MODEL, TRANSCRIPTION_PROMPT, preprocessing_settings(), chunking)
+
+class FileProcessingTimeout(Exception):
+    pass
+
+class PollStats:
+    def __init__(self):
+        self.files = 0
+        self.polls = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, polls: int, wait_seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.files += 1
+            self.polls += polls
+            self.wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "files": self.files,
+                "polls": self.polls,
+                "avg_polls": round(self.polls / self.files, 2) if self.files else 0.0,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "avg_wait_seconds": round(self.wait_seconds / self.files, 3) if self.files else 0.0,
+                "max_wait_seconds": round(self.max_wait_seconds, 3),
+                "timeouts": self.timeouts
+            }
+
+poll_stats = PollStats()
+
+def poll_schedule(size_bytes: int):
+    # Короткие записи Gemini обрабатывает за доли секунды, поэтому первые опросы частые;
+    # потолок интервала и общий срок ожидания растут вместе с размером файла
+    size_mb = size_bytes / (1024 * 1024)
+    max_interval = min(GEMINI_FILE_POLL_MAX_INTERVAL, max(GEMINI_FILE_POLL_INITIAL_INTERVAL * 2, size_mb))
+    timeout = GEMINI_FILE_PROCESSING_TIMEOUT + GEMINI_FILE_PROCESSING_TIMEOUT_PER_MB * size_mb
+    return max_interval, timeout
+
+async def wait_for_file(audio_file, size_bytes: int):
+    max_interval, timeout = poll_schedule(size_bytes)
+    started = time.monotonic()
+    deadline = started + timeout
+    interval = GEMINI_FILE_POLL_INITIAL_INTERVAL
+    polls = 0
+    while audio_file.state.name == "PROCESSING":
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            waited = time.monotonic() - started
+            poll_stats.record(polls, waited, timed_out=True)
+            raise FileProcessingTimeout(
+                f"Gemini не обработал файл {audio_file.name} за {timeout:.0f}с ({polls} проверок статуса)"
+            )
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(max_interval, interval * GEMINI_FILE_POLL_BACKOFF)
+        polls += 1
+        file_name = audio_file.name
+        audio_file = await call_with_retry_async(lambda: asyncio.to_thread(genai.get_file, file_name), "get_file")
+    waited = time.monotonic() - started
+    poll_stats.record(polls, waited)
+    return audio_file, polls, waited
+
+async def delete_uploaded_file(file_name: str):
+    try:
+        await asyncio.to_thread(genai.delete_file, file_name)
+    except Exception as e:
+        logger.warning(f"Не удалось удалить временный файл из Gemini: {e}")
+
+async def _transcribe_file(model, audio_path: str, on_progress=None, chunk: int = None, chunks: int = 1) -> str:
+    # У SDK нет асинхронной загрузки файлов, поэтому upload/get_file/delete_file идут через пул потоков,
+    # а ожидание обработки и генерация - на event loop планировщика
+    # upload_file не сообщает о ходе отправки, поэтому объем отдаем в начале и в конце загрузки
+    bytes_total = os.path.getsize(audio_path)
+    emit(on_progress, "upload", "start", chunk=chunk, chunks=chunks, bytes_total=bytes_total, bytes_sent=0)
+    audio_file = await call_with_retry_async(lambda: asyncio.to_thread(genai.upload_file, path=audio_path), "upload")
+    emit(on_progress, "upload", "end", chunk=chunk, chunks=chunks, bytes_total=bytes_total, bytes_sent=bytes_total)
+    logger.info(f"Аудио файл загружен в Gemini: {audio_file.uri}")
     
+    # Файл удаляется из Gemini при любом исходе, в том числе если обработка не уложилась в срок
     try:
-        model = genai.GenerativeModel(GEMINI_TRANSCRIPTION_MODEL)
-        
-        audio_file = genai.upload_file(path=audio_path)
-        logger.info(f"Аудио файл загружен в Gemini: {audio_file.uri}")
-        
-        while audio_file.state.name == "PROCESSING":
-            time.sleep(2)
-            audio_file = genai.get_file(audio_file.name)
+        emit(on_progress, "processing", "start", chunk=chunk, chunks=chunks)
+        audio_file, polls, waited = await wait_for_file(audio_file, bytes_total)
+        emit(on_progress, "processing", "end", chunk=chunk, chunks=chunks, polls=polls, file_state=audio_file.state.name)
+        logger.info(f"Файл {audio_file.name} обработан Gemini за {waited:.1f}с, проверок статуса: {polls}")
         
         if audio_file.state.name == "FAILED":
             raise Exception(f"Ошибка загрузки файла в Gemini: {audio_file.state}")
         
         logger.info("Отправка запроса на транскрипцию в Gemini API...")
         
-        prompt = "Транскрибируй этот аудио файл на русском языке. Верни только текст без дополнительных комментариев."
+        estimated_tokens = await asyncio.to_thread(estimate_audio_tokens, audio_path)
+        usage_tokens = {}
         
-        response = model.generate_content(
-            [prompt, audio_file],
-            generation_config=genai.types.GenerationConfig(
-                temperature=0,
-                response_mime_type="text/plain"
-            )
-        )
+        async def generate():
+            async with transcription_limiter.limit_async(estimated_tokens) as usage:
+                response = await model.generate_content_async(
+                    [TRANSCRIPTION_PROMPT, audio_file],
+                    generation_config=genai.types.GenerationConfig(
+                        temperature=0,
+                        response_mime_type="text/plain"
+                    )
+                )
+                usage["tokens"] = usage_tokens["tokens"] = response_tokens(response, estimated_tokens)
+                return response
+        
+        emit(on_progress, "generation", "start", chunk=chunk, chunks=chunks, estimated_tokens=estimated_tokens)
+        response = await call_with_retry_async(generate, "transcription")
+        emit(on_progress, "generation", "end", chunk=chunk, chunks=chunks, tokens=usage_tokens.get("tokens"))
         
         if not response:
             raise Exception("Gemini API вернул пустой ответ")
@@ -53,16 +167,99 @@ def transcribe_audio(audio_path: str) -> str:
         if not hasattr(response, 'text') or response.text is None:
             raise Exception("Gemini API не вернул текст транскрипции")
         
-        transcription = response.text.strip()
+        return response.text.strip()
+    finally:
+        await delete_uploaded_file(audio_file.name)
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r"[^\w]", "", word.lower())
+
+def _split_words(text: str) -> list:
+    # Пары (слово, пробелы после него): переносы строк внутри куска сохраняются при склейке
+    tokens = re.split(r"(\s+)", text.strip())
+    if tokens == [""]:
+        return []
+    return list(zip(tokens[0::2], tokens[1::2] + [""]))
+
+def stitch_transcripts(parts: list, max_overlap_words: int = TRANSCRIPTION_STITCH_WINDOW_WORDS) -> str:
+    result_words = []
+    for part in parts:
+        words = _split_words(part)
+        if not words:
+            continue
+        if result_words:
+            tail = result_words[-max_overlap_words:]
+            head = words[:max_overlap_words]
+            matcher = SequenceMatcher(
+                None, [_normalize_word(w) for w, _ in tail], [_normalize_word(w) for w, _ in head], autojunk=False
+            )
+            match = matcher.find_longest_match(0, len(tail), 0, len(head))
+            # Перекрытие засчитываем, только если совпал заметный фрагмент в конце предыдущего куска
+            if match.size >= 3 and match.a + match.size >= len(tail) - 3 and match.b <= len(head) // 2:
+                cut_tail = len(tail) - match.a
+                result_words = result_words[:len(result_words) - cut_tail]
+                words = words[match.b:]
+            if result_words and not result_words[-1][1]:
+                result_words[-1] = (result_words[-1][0], " ")
+        result_words.extend(words)
+    return "".join(word + separator for word, separator in result_words).strip()
+
+def _should_chunk(audio_path: str):
+    if not TRANSCRIPTION_CHUNKING_ENABLED or not ffmpeg_available():
+        return None
+    duration = probe_duration(audio_path)
+    if not duration or duration <= TRANSCRIPTION_CHUNK_SECONDS * 1.5:
+        return None
+    return duration
+
+async def _transcribe_chunked(model, audio_path: str, duration: float, on_progress=None) -> str:
+    silences = await asyncio.to_thread(detect_silences, audio_path)
+    chunks = plan_chunks(duration, silences, TRANSCRIPTION_CHUNK_SECONDS, TRANSCRIPTION_CHUNK_OVERLAP_SECONDS)
+    logger.info(f"Файл длительностью {duration:.0f}с разбит на {len(chunks)} фрагментов для параллельной транскрипции")
+    
+    with tempfile.TemporaryDirectory(prefix="chunks_") as tmp_dir:
+        chunk_paths = [
+            await asyncio.to_thread(
+                extract_segment, audio_path, start, end, os.path.join(tmp_dir, f"chunk_{index:03d}{SPEECH_EXTENSION}")
+            )
+            for index, (start, end) in enumerate(chunks)
+        ]
+        semaphore = asyncio.Semaphore(TRANSCRIPTION_CHUNK_CONCURRENCY)
+        
+        async def transcribe_chunk(index: int, path: str) -> str:
+            async with semaphore:
+                return await _transcribe_file(model, path, on_progress, chunk=index, chunks=len(chunk_paths))
+        
+        # TaskGroup отменяет остальные фрагменты при первой ошибке и дожидается их до удаления временной папки
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(transcribe_chunk(index, path)) for index, path in enumerate(chunk_paths)]
+        except ExceptionGroup as errors:
+            raise errors.exceptions[0]
+    
+    return stitch_transcripts([task.result() for task in tasks])
+
+def transcribe_audio(audio_path: str, on_progress=None) -> str:
+    return gemini_scheduler.run(transcribe_audio_async(audio_path, on_progress))
+
+async def transcribe_audio_async(audio_path: str, on_progress=None) -> str:
+    logger.info(f"Начало транскрипции файла: {audio_path}")
+    
+    if not os.path.exists(audio_path):
+        raise FileNotFoundError(f"Аудио файл не найден: {audio_path}")
+    
+    try:
+        model = genai.GenerativeModel(GEMINI_TRANSCRIPTION_MODEL)
+        
+        duration = await asyncio.to_thread(_should_chunk, audio_path)
+        if duration:
+            transcription = await _transcribe_chunked(model, audio_path, duration, on_progress)
+        else:
+            transcription = await _transcribe_file(model, audio_path, on_progress)
         
         if not transcription or len(transcription) == 0:
             raise Exception("Транскрипция пустая. Возможно, аудио файл не содержит речи или произошла ошибка при обработке.")
         
-        try:
-            genai.delete_file(audio_file.name)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временный файл из Gemini: {e}")
-        
         logger.info(f"Транскрипция завершена успешно, длина текста: {len(transcription)} символов")
         
         return transcription
@@ -1,36 +1,172 @@
 import logging
 import asyncio
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Dict, Set
 from fastapi import WebSocket
+from starlette.concurrency import run_in_threadpool
+
+from models import Call, SessionLocal
+from config import WS_CLIENT_QUEUE_SIZE, PROGRESS_SNAPSHOT_MAX_ENTRIES
+from services.pubsub import PROGRESS_CHANNEL, pubsub
 
 logger = logging.getLogger(__name__)
 
+IN_FLIGHT_STATUSES = ("queued", "processing")
+
+@lru_cache(maxsize=PROGRESS_SNAPSHOT_MAX_ENTRIES)
+def call_manager(call_id: int):
+    db = SessionLocal()
+    try:
+        row = db.query(Call.manager).filter(Call.id == call_id).first()
+        return row.manager if row else None
+    finally:
+        db.close()
+
+def stored_progress(call_ids: list = None, manager_name: str = None) -> list:
+    db = SessionLocal()
+    try:
+        query = db.query(Call.id, Call.status, Call.progress)
+        if call_ids is not None:
+            query = query.filter(Call.id.in_(call_ids))
+        else:
+            query = query.filter(Call.manager == manager_name, Call.status.in_(IN_FLIGHT_STATUSES))
+        return [
+            {"call_id": row.id, "progress": row.progress or 0, "status": row.status or "pending"}
+            for row in query.all()
+        ]
+    finally:
+        db.close()
+
+class ProgressSubscriber:
+    # Ограниченная очередь на клиента: медленный клиент теряет устаревшие проценты, а не тормозит рассылку остальным
+    def __init__(self, queue_size: int = WS_CLIENT_QUEUE_SIZE):
+        self.call_ids = set()
+        self.managers = set()
+        self.queue = asyncio.Queue(maxsize=max(1, queue_size))
+        self.dropped = 0
+    
+    def offer(self, data: dict):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(data)
+
 class WebSocketManager:
     def __init__(self):
-        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        self.subscribers_by_call: Dict[int, Set[ProgressSubscriber]] = {}
+        self.subscribers_by_manager: Dict[str, Set[ProgressSubscriber]] = {}
+        self.connections = 0
+        self.snapshots = OrderedDict()
+        self._snapshots_lock = threading.Lock()
         self._loop = None
     
     def set_event_loop(self, loop):
         self._loop = loop
     
-    async def connect(self, websocket: WebSocket, call_id: int):
+    def register(self) -> ProgressSubscriber:
+        self.connections += 1
+        return ProgressSubscriber()
+    
+    async def connect(self, websocket: WebSocket, call_id: int = None) -> ProgressSubscriber:
         await websocket.accept()
-        if call_id not in self.active_connections:
-            self.active_connections[call_id] = set()
-        self.active_connections[call_id].add(websocket)
-        logger.info(f"WebSocket подключен для звонка {call_id}")
-    
-    def disconnect(self, websocket: WebSocket, call_id: int):
-        if call_id in self.active_connections:
-            self.active_connections[call_id].discard(websocket)
-            if not self.active_connections[call_id]:
-                del self.active_connections[call_id]
-        logger.info(f"WebSocket отключен для звонка {call_id}")
-    
-    async def send_progress(self, call_id: int, progress: int, status: str, message: str = None):
-        if call_id not in self.active_connections:
-            return
+        subscriber = self.register()
+        if call_id is not None:
+            await self.subscribe(subscriber, call_ids=[call_id])
+            logger.info(f"WebSocket подключен для звонка {call_id}")
+        return subscriber
+    
+    def disconnect(self, subscriber: ProgressSubscriber):
+        self.unsubscribe(subscriber, call_ids=list(subscriber.call_ids), managers=list(subscriber.managers))
+        self.connections -= 1
+        if subscriber.dropped:
+            logger.info(f"Клиенту прогресса не доставлено устаревших сообщений: {subscriber.dropped}")
+    
+    async def pump(self, websocket: WebSocket, subscriber: ProgressSubscriber):
+        try:
+            while True:
+                data = await subscriber.queue.get()
+                await websocket.send_json(data)
+        except Exception as e:
+            # Клиент отключился, сокет закроет обработчик подключения
+            logger.info(f"Отправка прогресса в WebSocket прекращена: {e}")
+    
+    async def subscribe(self, subscriber: ProgressSubscriber, call_ids: list = None, managers: list = None):
+        call_ids = [call_id for call_id in (call_ids or []) if call_id not in subscriber.call_ids]
+        managers = [name for name in (managers or []) if name not in subscriber.managers]
+        
+        # Сначала читаем сохраненное состояние из БД, и только потом подписываем: иначе живое обновление,
+        # пришедшее во время чтения, окажется в очереди раньше более старой строки из БД
+        missing = [call_id for call_id in call_ids if self.snapshot(call_id) is None]
+        stored = {data["call_id"]: data for data in await run_in_threadpool(stored_progress, missing)} if missing else {}
+        manager_rows = []
+        for name in managers:
+            manager_rows.extend(await run_in_threadpool(stored_progress, None, name))
         
+        # Дальше без await: все, что придет после, будет разослано уже с этим подписчиком
+        for call_id in call_ids:
+            subscriber.call_ids.add(call_id)
+            self.subscribers_by_call.setdefault(call_id, set()).add(subscriber)
+        for name in managers:
+            subscriber.managers.add(name)
+            self.subscribers_by_manager.setdefault(name, set()).add(subscriber)
+        
+        # Поздно подключившийся клиент сразу получает последнее известное состояние
+        for call_id in call_ids:
+            data = self.snapshot(call_id) or stored.get(call_id)
+            if data:
+                subscriber.offer(data)
+        for data in manager_rows:
+            subscriber.offer(self.snapshot(data["call_id"]) or data)
+    
+    def unsubscribe(self, subscriber: ProgressSubscriber, call_ids: list = None, managers: list = None):
+        for call_id in call_ids or []:
+            subscriber.call_ids.discard(call_id)
+            subscribers = self.subscribers_by_call.get(call_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers_by_call[call_id]
+        for name in managers or []:
+            subscriber.managers.discard(name)
+            subscribers = self.subscribers_by_manager.get(name)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers_by_manager[name]
+    
+    async def handle_command(self, subscriber: ProgressSubscriber, command: dict) -> dict:
+        if not isinstance(command, dict):
+            return {"type": "error", "detail": "Ожидается JSON-объект с полем action"}
+        action = command.get("action")
+        if action not in ("subscribe", "unsubscribe"):
+            return {"type": "error", "detail": f"Неизвестное действие: {action}"}
+        try:
+            call_ids = [int(call_id) for call_id in command.get("call_ids") or []]
+        except (TypeError, ValueError):
+            return {"type": "error", "detail": "call_ids должен быть списком чисел"}
+        managers = command.get("managers") or ([command["manager"]] if command.get("manager") else [])
+        if action == "subscribe":
+            await self.subscribe(subscriber, call_ids, managers)
+        else:
+            self.unsubscribe(subscriber, call_ids, managers)
+        return {"type": "subscriptions", "call_ids": sorted(subscriber.call_ids), "managers": sorted(subscriber.managers)}
+    
+    def snapshot(self, call_id: int):
+        with self._snapshots_lock:
+            data = self.snapshots.get(call_id)
+            return dict(data) if data else None
+    
+    def remember(self, data: dict):
+        with self._snapshots_lock:
+            self.snapshots[data["call_id"]] = data
+            self.snapshots.move_to_end(data["call_id"])
+            while len(self.snapshots) > PROGRESS_SNAPSHOT_MAX_ENTRIES:
+                self.snapshots.popitem(last=False)
+    
+    def progress_message(self, call_id: int, progress: int, status: str, message: str = None,
+                         phase: str = None, eta_seconds: float = None) -> dict:
         data = {
             "call_id": call_id,
             "progress": progress,
@@ -38,33 +174,46 @@ class WebSocketManager:
         }
         if message:
             data["message"] = message
-        
-        disconnected = set()
-        for websocket in self.active_connections[call_id]:
-            try:
-                await websocket.send_json(data)
-            except Exception as e:
-                logger.error(f"Ошибка отправки WebSocket сообщения: {e}")
-                disconnected.add(websocket)
-        
-        for ws in disconnected:
-            self.disconnect(ws, call_id)
+        if phase:
+            data["phase"] = phase
+        if eta_seconds is not None:
+            data["eta_seconds"] = round(eta_seconds, 1)
+        return data
     
-    def send_progress_sync(self, call_id: int, progress: int, status: str, message: str = None):
-        if self._loop and self._loop.is_running():
-            asyncio.run_coroutine_threadsafe(
-                self.send_progress(call_id, progress, status, message),
-                self._loop
-            )
-        else:
+    async def send_progress(self, call_id: int, progress: int, status: str, message: str = None,
+                            phase: str = None, eta_seconds: float = None):
+        self.send_progress_sync(call_id, progress, status, message, phase, eta_seconds)
+    
+    def send_progress_sync(self, call_id: int, progress: int, status: str, message: str = None,
+                           phase: str = None, eta_seconds: float = None):
+        # Прогресс публикуется в pub/sub, а подписчикам его раздает тот процесс, к которому они подключены
+        pubsub.publish(PROGRESS_CHANNEL, self.progress_message(call_id, progress, status, message, phase, eta_seconds))
+    
+    def on_progress_message(self, data: dict):
+        self.remember(data)
+        manager_name = None
+        if self.subscribers_by_manager:
             try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    asyncio.create_task(self.send_progress(call_id, progress, status, message))
-                else:
-                    loop.run_until_complete(self.send_progress(call_id, progress, status, message))
+                manager_name = call_manager(data["call_id"])
             except Exception as e:
-                logger.warning(f"Ошибка отправки WebSocket обновления: {e}")
+                logger.warning(f"Не удалось определить менеджера звонка {data['call_id']}: {e}")
+        if self._loop and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self.dispatch, data, manager_name)
+    
+    def dispatch(self, data: dict, manager_name: str = None):
+        subscribers = set(self.subscribers_by_call.get(data["call_id"], ()))
+        if manager_name is not None:
+            subscribers.update(self.subscribers_by_manager.get(manager_name, ()))
+        for subscriber in subscribers:
+            subscriber.offer(data)
+    
+    def stats(self) -> dict:
+        return {
+            "connections": self.connections,
+            "watched_calls": len(self.subscribers_by_call),
+            "watched_managers": len(self.subscribers_by_manager),
+            "snapshots": len(self.snapshots)
+        }
 
 manager = WebSocketManager()
-
+pubsub.subscribe(PROGRESS_CHANNEL, manager.on_progress_message)
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Тесты запускаются из backend/, модули импортируются так же, как в приложении
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='ai_coach_tests_'), 'test.db')}")
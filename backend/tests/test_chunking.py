@@ -0,0 +1,44 @@
+from services.audio_service import plan_chunks
+from services.transcription_service import stitch_transcripts
+
+def test_short_audio_is_single_chunk():
+    assert plan_chunks(90.0, [], 300, 5) == [(0.0, 90.0)]
+
+def test_chunks_cover_audio_with_overlap():
+    chunks = plan_chunks(1000.0, [], 300, 5)
+    assert chunks[0][0] == 0.0
+    assert chunks[-1][1] == 1000.0
+    for previous, current in zip(chunks, chunks[1:]):
+        assert current[0] == previous[1] - 5
+    assert all(end - start <= 305 for start, end in chunks)
+
+def test_boundary_snaps_to_nearest_pause():
+    silences = [(100.0, 102.0), (290.0, 294.0), (330.0, None)]
+    chunks = plan_chunks(500.0, silences, 300, 5)
+    assert chunks[0] == (0.0, 292.0)
+    assert chunks[1][0] == 287.0
+
+def test_boundary_without_pause_falls_back_to_chunk_length():
+    chunks = plan_chunks(700.0, [(10.0, 11.0)], 300, 5)
+    assert [end for _, end in chunks] == [300.0, 600.0, 700.0]
+
+def test_stitch_removes_overlap():
+    parts = [
+        "Добрый день, меня зовут Анна. Чем могу помочь вам сегодня",
+        "помочь вам сегодня? Я хотел бы уточнить заказ",
+    ]
+    assert stitch_transcripts(parts) == "Добрый день, меня зовут Анна. Чем могу помочь вам сегодня? Я хотел бы уточнить заказ"
+
+def test_stitch_keeps_line_breaks():
+    parts = [
+        "Менеджер: Добрый день.\nКлиент: Здравствуйте, я по поводу доставки заказа",
+        "по поводу доставки заказа номер пять.\nМенеджер: Сейчас проверю.",
+    ]
+    assert stitch_transcripts(parts) == (
+        "Менеджер: Добрый день.\nКлиент: Здравствуйте, я по поводу доставки заказа номер пять.\nМенеджер: Сейчас проверю."
+    )
+
+def test_stitch_without_overlap_joins_with_space():
+    assert stitch_transcripts(["Первая часть разговора", "", "совсем другой текст\nвторая строка"]) == (
+        "Первая часть разговора совсем другой текст\nвторая строка"
+    )
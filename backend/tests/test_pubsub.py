@@ -0,0 +1,50 @@
+import socket
+import threading
+import time
+
+from services.pubsub import LocalPubSub
+
+def free_address() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"127.0.0.1:{sock.getsockname()[1]}"
+
+class Inbox:
+    def __init__(self, expected: int):
+        self.messages = []
+        self.expected = expected
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, message: dict):
+        with self._lock:
+            self.messages.append(message)
+            if len(self.messages) >= self.expected:
+                self.done.set()
+
+def test_local_broker_round_trip_between_two_processes():
+    address = free_address()
+    first, second = LocalPubSub(address), LocalPubSub(address)
+    first_inbox, second_inbox = Inbox(2), Inbox(2)
+    first.subscribe("call_progress", first_inbox)
+    second.subscribe("call_progress", second_inbox)
+    try:
+        first.start()
+        second.start()
+        # Брокер поднимает первый экземпляр, второй подключается к нему как клиент
+        assert first.broker is not None and second.broker is None
+        # Соединение принято, но брокер регистрирует клиента в своем потоке
+        deadline = time.monotonic() + 5
+        while len(first.broker.clients) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        first.publish("call_progress", {"call_id": 1, "progress": 10})
+        second.publish("call_progress", {"call_id": 2, "progress": 20})
+
+        assert first_inbox.done.wait(5) and second_inbox.done.wait(5)
+        expected = [{"call_id": 1, "progress": 10}, {"call_id": 2, "progress": 20}]
+        for inbox in (first_inbox, second_inbox):
+            assert sorted(inbox.messages, key=lambda message: message["call_id"]) == expected
+    finally:
+        second.stop()
+        first.stop()
@@ -0,0 +1,13 @@
+from models import engine, init_db
+from utils.query_plans import check_query_plans, compile_query, hot_queries
+from sqlalchemy.orm import Session
+
+def test_hot_queries_use_indexes():
+    init_db()
+    assert check_query_plans(engine) == {}
+
+def test_hot_queries_match_route_builders():
+    with Session(engine) as db:
+        sql, _ = compile_query(hot_queries(db)["calls_by_call_date"], engine.dialect)
+    assert "ORDER BY calls.created_at DESC, calls.id DESC" in sql
+    assert "LIMIT" in sql
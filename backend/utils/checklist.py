@@ -1,3 +1,7 @@
+import hashlib
+import json
+from functools import lru_cache
+
 CHECKLIST = {
     "Установление контакта": {
         "1.1 Приветствие": {
@@ -136,3 +140,22 @@ def get_checklist_prompt():
     return prompt
 
 
+
+@lru_cache(maxsize=1)
+def get_checklist_version():
+    content = json.dumps(CHECKLIST, ensure_ascii=False, sort_keys=True) + get_checklist_prompt()
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+@lru_cache(maxsize=1)
+def get_criteria():
+    criteria = []
+    for stage_name, items in CHECKLIST.items():
+        for item_key, item_data in items.items():
+            criteria.append({
+                "key": item_key.split(" ")[0].rstrip("."),
+                "name": item_key,
+                "stage": stage_name,
+                "max_score": item_data.get("max", {}).get("score"),
+                "violation": bool(item_data.get("violation"))
+            })
+    return criteria
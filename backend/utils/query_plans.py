@@ -0,0 +1,89 @@
+import json
+import logging
+import sys
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+def hot_queries(db) -> dict:
+    # Запросы строятся теми же функциями, что используют обработчики и сервисы, поэтому проверка не расходится с кодом
+    from api.routes import calls_page_query, call_evaluations_query, export_query, rollups_query, encode_cursor
+    from services.job_queue import job_queue
+    from services.cache_service import evaluation_cache
+
+    cursor = encode_cursor(datetime(2024, 1, 1), 1000)
+    return {
+        "calls_page": calls_page_query(db, None, None, None, None, 50),
+        "calls_page_cursor": calls_page_query(db, None, None, None, cursor, 50),
+        "calls_by_manager": calls_page_query(db, "Иванов", None, None, None, 50),
+        "calls_by_call_date": calls_page_query(db, None, "2024-01-01", "2024-02-01", None, 50),
+        "call_evaluations": call_evaluations_query(db, 1),
+        "export_latest_evaluations": export_query(db, "Иванов", None, None),
+        "analytics_rollups": rollups_query(db, "month", "Иванов", "2024-01-01", None),
+        "queue_claim": job_queue.claim_query(db, datetime(2024, 1, 1)).limit(1),
+        "cache_lookup": evaluation_cache.entry_query(db, "0" * 64),
+        "cache_eviction": evaluation_cache.eviction_query(db),
+    }
+
+def compile_query(query, dialect):
+    compiled = query.statement.compile(dialect=dialect)
+    params = compiled.construct_params()
+    if compiled.positiontup is not None:
+        params = tuple(params[name] for name in compiled.positiontup)
+    return str(compiled), params
+
+def sqlite_plan(conn, sql: str, params) -> list:
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row[-1] for row in rows]
+
+def sqlite_full_scans(plan: list) -> list:
+    # "SCAN calls USING INDEX ..." - упорядоченный обход индекса, без USING - полный проход по таблице
+    return [step for step in plan if step.startswith("SCAN ") and " USING " not in step]
+
+def postgres_plan(conn, sql: str, params) -> list:
+    with conn.begin():
+        # На маленьких таблицах Postgres выбирает Seq Scan даже при наличии индекса,
+        # поэтому проверяем, что индексный план вообще возможен
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}", params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan
+
+def postgres_full_scans(plan: list) -> list:
+    scans = []
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if node.get("Node Type") == "Seq Scan":
+            scans.append(f"Seq Scan on {node.get('Relation Name')}")
+        nodes.extend(node.get("Plans", []))
+    return scans
+
+def check_query_plans(engine) -> dict:
+    failures = {}
+    dialect = engine.dialect
+    with Session(engine) as db:
+        queries = {name: compile_query(query, dialect) for name, query in hot_queries(db).items()}
+    with engine.connect() as conn:
+        for name, (sql, params) in queries.items():
+            if dialect.name == "postgresql":
+                plan = postgres_plan(conn, sql, params)
+                scans = postgres_full_scans(plan)
+            else:
+                plan = sqlite_plan(conn, sql, params)
+                scans = sqlite_full_scans(plan)
+            if scans:
+                failures[name] = scans
+                logger.error(f"Запрос {name} выполняется полным проходом: {'; '.join(scans)}")
+            else:
+                logger.info(f"Запрос {name} использует индексы")
+    return failures
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    from models import engine, init_db
+    init_db()
+    sys.exit(1 if check_query_plans(engine) else 0)
@@ -0,0 +1,111 @@
+import re
+from functools import lru_cache
+
+# Облегченная версия русского стеммера Snowball (Портера): только окончания, без словарей
+VOWELS = "аеиоуыэюя"
+WORD_RE = re.compile(r"[0-9a-zа-яё]+", re.IGNORECASE)
+
+PERFECTIVE_GERUND = (["вшись", "вши", "в"], ["ывшись", "ившись", "ывши", "ивши", "ыв", "ив"])
+REFLEXIVE = ["ся", "сь"]
+ADJECTIVE = [
+    "ими", "ыми", "его", "ого", "ему", "ому",
+    "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом",
+    "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею"
+]
+PARTICIPLE = (["ем", "нн", "вш", "ющ", "щ"], ["ивш", "ывш", "ующ"])
+VERB = (
+    ["ете", "йте", "ешь", "нно", "ла", "на", "ли", "ем", "ло", "но", "ет", "ют", "ны", "ть", "й", "л", "н"],
+    [
+        "ейте", "уйте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено", "ует", "уют",
+        "ены", "ить", "ыть", "ишь", "ей", "уй", "ил", "ыл", "им", "ым", "ен", "ят", "ит", "ыт", "ую", "ю"
+    ]
+)
+NOUN = [
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях",
+    "ев", "ов", "ие", "ье", "еи", "ии", "ей", "ой", "ий", "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия", "ья",
+    "а", "е", "и", "й", "о", "у", "ы", "ь", "ю", "я"
+]
+SUPERLATIVE = ["ейше", "ейш"]
+DERIVATIONAL = ["ость", "ост"]
+
+def _regions(word: str):
+    rv = r1 = r2 = len(word)
+    for index, char in enumerate(word):
+        if char in VOWELS:
+            rv = index + 1
+            break
+    for index in range(1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            r1 = index + 1
+            break
+    for index in range(r1 + 1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            r2 = index + 1
+            break
+    return rv, r2
+
+def _strip(rv: str, endings: list, preceded_by_a: bool = False):
+    for ending in sorted(endings, key=len, reverse=True):
+        if rv.endswith(ending):
+            stem = rv[:-len(ending)]
+            if preceded_by_a and not stem.endswith(("а", "я")):
+                continue
+            return stem
+    return None
+
+def _strip_groups(rv: str, groups: tuple):
+    stem = _strip(rv, groups[1])
+    if stem is None:
+        stem = _strip(rv, groups[0], preceded_by_a=True)
+    return stem
+
+@lru_cache(maxsize=50000)
+def stem(word: str) -> str:
+    word = word.lower().replace("ё", "е")
+    if not re.fullmatch(r"[а-я]+", word):
+        return word
+    rv_start, r2_start = _regions(word)
+    prefix, rv = word[:rv_start], word[rv_start:]
+
+    stemmed = _strip_groups(rv, PERFECTIVE_GERUND)
+    if stemmed is None:
+        reflexive = _strip(rv, REFLEXIVE)
+        if reflexive is not None:
+            rv = reflexive
+        stemmed = _strip(rv, ADJECTIVE)
+        if stemmed is not None:
+            participle = _strip_groups(stemmed, PARTICIPLE)
+            if participle is not None:
+                stemmed = participle
+        else:
+            stemmed = _strip_groups(rv, VERB)
+            if stemmed is None:
+                stemmed = _strip(rv, NOUN)
+        if stemmed is None:
+            stemmed = rv
+    rv = stemmed
+
+    if rv.endswith("и"):
+        rv = rv[:-1]
+
+    r2 = r2_start - rv_start
+    for ending in DERIVATIONAL:
+        if rv.endswith(ending) and len(rv) - len(ending) >= r2:
+            rv = rv[:-len(ending)]
+            break
+
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    else:
+        superlative = _strip(rv, SUPERLATIVE)
+        if superlative is not None:
+            rv = superlative[:-1] if superlative.endswith("нн") else superlative
+        elif rv.endswith("ь"):
+            rv = rv[:-1]
+    return prefix + rv
+
+def tokenize(text: str) -> list:
+    return WORD_RE.findall(text or "")
+
+def stem_text(text: str) -> str:
+    return " ".join(stem(token) for token in tokenize(text))
@@ -11,26 +11,37 @@ export default function HistoryPage() {
   const [manager, setManager] = useState("");
   const [startDate, setStartDate] = useState("");
   const [endDate, setEndDate] = useState("");
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     loadCalls();
   }, []);
 
-  const loadCalls = async () => {
+  const loadCalls = async (cursor?: string) => {
     try {
       const data = await getCalls(
         manager || undefined,
         startDate || undefined,
-        endDate || undefined
+        endDate || undefined,
+        cursor
       );
-      setCalls(data);
+      setCalls((prev) => (cursor ? [...prev, ...data.calls] : data.calls));
+      setNextCursor(data.next_cursor);
     } catch (error) {
       console.error("Error loading calls:", error);
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
+  const handleLoadMore = () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    loadCalls(nextCursor);
+  };
+
   const handleFilter = () => {
     setLoading(true);
     loadCalls();
@@ -157,6 +168,17 @@ export default function HistoryPage() {
           {calls.length === 0 && (
             <div className="text-center py-8 text-gray-500">Нет звонков</div>
           )}
+          {nextCursor && (
+            <div className="text-center py-4">
+              <button
+                onClick={handleLoadMore}
+                disabled={loadingMore}
+                className="px-4 py-2 border border-gray-300 rounded hover:bg-gray-100 disabled:opacity-50"
+              >
+                {loadingMore ? "Загрузка..." : "Загрузить еще"}
+              </button>
+            </div>
+          )}
         </div>
       )}
     </div>
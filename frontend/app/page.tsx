@@ -48,8 +48,8 @@ export default function Home() {
 
   const loadRecentCalls = async () => {
     try {
-      const data = await getCalls();
-      setRecentCalls(data.slice(0, 5));
+      const data = await getCalls(undefined, undefined, undefined, undefined, 5);
+      setRecentCalls(data.calls);
     } catch (error: any) {
       console.error("Error loading calls:", error);
     }
@@ -194,16 +194,25 @@ export async function retestCall(callId: number): Promise<any> {
   }
 }
 
+export interface CallsPage {
+  calls: Call[];
+  next_cursor: string | null;
+}
+
 export async function getCalls(
   manager?: string,
   startDate?: string,
-  endDate?: string
-): Promise<Call[]> {
+  endDate?: string,
+  cursor?: string,
+  limit?: number
+): Promise<CallsPage> {
   try {
     const params = new URLSearchParams();
     if (manager) params.append("manager", manager);
     if (startDate) params.append("start_date", startDate);
     if (endDate) params.append("end_date", endDate);
+    if (cursor) params.append("cursor", cursor);
+    if (limit) params.append("limit", String(limit));
     
     const response = await fetch(`${API_URL}/api/calls?${params.toString()}`);
     
@@ -211,8 +220,7 @@ export async function getCalls(
       throw new Error(`Failed to fetch calls: ${response.status}`);
     }
     
-    const data = await response.json();
-    return data.calls;
+    return response.json();
   } catch (error: any) {
     console.error("Error fetching calls:", {
       error: error.message,